@@ -0,0 +1,41 @@
+import argparse
+import logging
+from dataclasses import dataclass
+from pathlib import Path
+from typing import cast
+
+from mbtibench.enums import LabelType, MbtiDimension
+from mbtibench.executer import Executer
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class Arguments:
+    results_dir: Path
+    dataset: Path
+
+
+def main(args: Arguments):
+    # Result databases are named {type}--{model}--{method}.db, see inference.py
+    for database_path in sorted(args.results_dir.glob("round-*/*.db")):
+        try:
+            type = LabelType(database_path.name.split("--")[0])
+        except ValueError:
+            logger.warning(f"Skipping {database_path}, not a result database")
+            continue
+
+        backfilled = 0
+        for dim in MbtiDimension:
+            executer = Executer(args.dataset, database_path, dim, type)
+            backfilled += executer.backfill_parsed_responses()
+        print(f"{database_path}: {backfilled} rows backfilled")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="MbtiBench Backfill Parsed Predictions")
+    parser.add_argument("--results_dir", type=Path, help="Results directory", default=Path("results"))
+    parser.add_argument("--dataset", type=Path, help="Dataset file", default=Path("dataset") / "mbtibench.jsonl")
+    args = cast(Arguments, parser.parse_args())
+
+    main(args)
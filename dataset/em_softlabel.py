@@ -1,929 +1,632 @@
+import argparse
 import json
 import os
+import sys
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Optional, Tuple, cast
 
-import matplotlib.pyplot as plt
 import numpy as np
 
+DIMS = ["E/I", "S/N", "T/F", "J/P"]
+
+
+@dataclass
+class Annotations:
+    # One entry per given label, sorted by dim, user and annotator. Annotators a user was not shown to, or who left
+    # the label empty, have no entry, so rotating annotator pools cost memory per label instead of per annotator.
+    dims: np.ndarray  # int8
+    users: np.ndarray  # int32
+    annotators: np.ndarray  # int32, index into annotator_names
+    categories: np.ndarray  # int8, index into get_categories(dim)
+    n_users: int
+    annotator_names: List[str]
+
+    @property
+    def n_annotators(self) -> int:
+        return len(self.annotator_names)
+
+
+def get_categories(dim: str) -> List[str]:
+    # Annotation categories of a dimension ordered from the first letter to the second, e.g. E+ E- I- I+
+    return [f"{dim[0]}+", f"{dim[0]}-", f"{dim[-1]}-", f"{dim[-1]}+"]
+
+
+def encode_annotations(dataset: Iterable[Dict]) -> Annotations:
+    # One pass over the records, so a stream of them works too. Annotators are numbered in order of first appearance,
+    # e.g. A1 A2 A3 for MbtiBench.
+    category_mappings = [{category: i for i, category in enumerate(get_categories(dim))} for dim in DIMS]
+    annotator_index: Dict[str, int] = {}
+    entries = []
+    n_users = 0
+    for u, data in enumerate(dataset):
+        for d, dim in enumerate(DIMS):
+            for name, label in data["annotation"].get(dim, {}).items():
+                if not label:
+                    continue
+                a = annotator_index.setdefault(name, len(annotator_index))
+                entries.append((d, u, a, category_mappings[d][label]))
+        n_users = u + 1
+    entries.sort()
+
+    columns = np.array(entries, dtype=np.int64).reshape(-1, 4).T
+    return Annotations(
+        dims=columns[0].astype(np.int8),
+        users=columns[1].astype(np.int32),
+        annotators=columns[2].astype(np.int32),
+        categories=columns[3].astype(np.int8),
+        n_users=n_users,
+        annotator_names=list(annotator_index),
+    )
 
-def processei(file_paths, tolerance, max_iterations):
-    list1, list2, list3 = [], [], []
 
-    # # Read data from provided file paths
-    # for file_path in file_paths:
-    #     df = pd.read_excel(file_path)
-    #     list1.extend(df.get('IEWXH', []).tolist())
-    #     list2.extend(df.get('IEWJM', []).tolist())
-    #     list3.extend(df.get('IETSY', []).tolist())
-    # 读取 JSONL 文件中的 E/I 维度标签
-    for file_path in file_paths:
-        with open(file_path, "r", encoding="utf-8") as f:
-            for line in f:
-                data = json.loads(line)
-                annotation = data.get("annotation", {}).get("E/I", {})
-                list1.append(annotation.get("A1", ""))  # 获取 A1 的 E/I 标签
-                list2.append(annotation.get("A2", ""))  # 获取 A2 的 E/I 标签
-                list3.append(annotation.get("A3", ""))  # 获取 A3 的 E/I 标签
-
-    # Mapping categories to numerical values
-    category_mapping = {"E+": 0, "E-": 1, "I-": 2, "I+": 3}
-    z_init = []
-
-    # Determine the middle value based on the sorted mapped values
-    for i in range(len(list1)):
-        mapped_values = [category_mapping[list1[i]], category_mapping[list2[i]], category_mapping[list3[i]]]
-        middle_mapped_value = sorted(mapped_values)[1]
-        original_category = [key for key, value in category_mapping.items() if value == middle_mapped_value][0]
-        z_init.append(original_category)
-
-    # Initialize count matrix
-    matrix_size = len(category_mapping)
-    count_matrix = np.zeros((3, matrix_size, matrix_size), dtype=int)
-
-    # Populate count matrix with category data
-    for i in range(len(list1)):
-        cat1 = category_mapping[list1[i]]
-        cat2 = category_mapping[list2[i]]
-        cat3 = category_mapping[list3[i]]
-        z_cat = category_mapping[z_init[i]]
-        count_matrix[0, z_cat, cat1] += 1
-        count_matrix[1, z_cat, cat2] += 1
-        count_matrix[2, z_cat, cat3] += 1
-
-    # Add smoothing by incrementing all values by 1
-    count_matrix += 1
-
-    # Calculate counts and probabilities
-    count0 = np.sum(count_matrix[:, 0, :])
-    count1 = np.sum(count_matrix[:, 1, :])
-    count2 = np.sum(count_matrix[:, 2, :])
-    count3 = np.sum(count_matrix[:, 3, :])
-    count = count0 + count1 + count2 + count3
-    PE1, PE2 = count0 / count, count1 / count
-    PI1, PI2 = count2 / count, count3 / count
-    PE = PE1 + PE2
-    PI = PI1 + PI2
-
-    # Function to get probability values
-    def get_pr_values(value, matrix, index):
-        if value == "E+":
-            return matrix[index][0][0], matrix[index][1][0]
-        elif value == "E-":
-            return matrix[index][0][1], matrix[index][1][1]
-        elif value == "I-":
-            return matrix[index][0][2], matrix[index][1][2]
-        elif value == "I+":
-            return matrix[index][0][3], matrix[index][1][3]
-
-    # Initialize the result based on categories
-    initial_resultes = [1 if z in ["E+", "E-"] else 0 for z in z_init]
-
-    # Create a new matrix to update probabilities
-    new_matrix = np.zeros((3, 2, 4))
-    for i in range(3):
-        new_matrix[i, 0] = ((count_matrix[i, 0] * PE1) + (count_matrix[i, 1] * PE2)) / PE
-        new_matrix[i, 1] = ((count_matrix[i, 2] * PI1) + (count_matrix[i, 3] * PI2)) / PI
-
-    iteration = 0
-    previous_resultes = initial_resultes
-
-    # Function to calculate result probabilities
-    def calculate_resulte(list1, list2, list3, matrix, PE, PI):
-        resultes = []
-        for i in range(len(list1)):
-            pr1e, pr1i = get_pr_values(list1[i], matrix, 0)
-            pr2e, pr2i = get_pr_values(list2[i], matrix, 1)
-            pr3e, pr3i = get_pr_values(list3[i], matrix, 2)
-            product_e = pr1e * pr2e * pr3e * PE
-            product_i = pr1i * pr2i * pr3i * PI
-            total = product_e + product_i
-            resulte = product_e / (total if total != 0 else 1)
-            resultes.append(resulte)
-        return resultes
-
-    # Iteratively update results until convergence or reaching max iterations
-    while iteration < max_iterations:
-        resultes = calculate_resulte(list1, list2, list3, new_matrix, PE, PI)
-        PE = sum([1 for r in resultes if r > 0.5]) / len(resultes)
-        PI = 1 - PE
-        diff = np.abs(np.array(resultes) - np.array(previous_resultes)).max()
-        if diff < tolerance:
-            break
-        previous_resultes = resultes
-
-        # Update count matrix with new results
-        new_count_matrix = np.zeros((3, 2, 4), dtype=float)
-        for i in range(len(list1)):
-            cat1 = category_mapping[list1[i]]
-            cat2 = category_mapping[list2[i]]
-            cat3 = category_mapping[list3[i]]
-            new_count_matrix[0, 0, cat1] += resultes[i]
-            new_count_matrix[0, 1, cat1] += 1 - resultes[i]
-            new_count_matrix[1, 0, cat2] += resultes[i]
-            new_count_matrix[1, 1, cat2] += 1 - resultes[i]
-            new_count_matrix[2, 0, cat3] += resultes[i]
-            new_count_matrix[2, 1, cat3] += 1 - resultes[i]
-
-        # Normalize the new matrix
-        new_matrix = np.copy(new_count_matrix)
-        for layer in range(new_matrix.shape[0]):
-            for row in range(new_matrix.shape[1]):
-                row_sum = np.sum(new_matrix[layer, row])
-                if row_sum > 0:
-                    new_matrix[layer, row] = new_matrix[layer, row] / row_sum
-
-        iteration += 1
-
-    # Final results calculation
-    final_results = []
-    for i in range(len(list1)):
-        pr1e, pr1i = get_pr_values(list1[i], new_matrix, 0)
-        pr2e, pr2i = get_pr_values(list2[i], new_matrix, 1)
-        pr3e, pr3i = get_pr_values(list3[i], new_matrix, 2)
-        product_e = pr1e * pr2e * pr3e * PE
-        product_i = pr1i * pr2i * pr3i * PI
-        total = product_e + product_i
-        resulte = product_e / total
-        combination = f"{list1[i]}{list2[i]}{list3[i]}"
-        final_results.append((combination, resulte))
-
-    # Deduplicate and sort final results
-    final_results = list(set(final_results))
-    final_results.sort(key=lambda x: x[1], reverse=True)
-
-    # Frequency analysis of combinations
-    frequency_dict = {}
-    for i in range(len(list1)):
-        combination = f"{list1[i]}{list2[i]}{list3[i]}"
-        frequency_dict[combination] = frequency_dict.get(combination, 0) + 1
-
-    final_results_with_freq = [
-        (combination, resulte, frequency_dict.get(combination, 0)) for combination, resulte in final_results
-    ]
-
-    # Sort results and find the median
-    final_results_with_freq.sort(key=lambda x: x[1])
-    mid_index = next(
-        (i for i, item in enumerate(final_results_with_freq) if item[1] >= 0.5), len(final_results_with_freq)
+class _EM:
+    # E- and M-steps over the sparse labels of all dimensions, with the flat indices computed once. Every array has a
+    # leading replicate axis: replicate r counts user u weights[r, u] times, so bootstrap resamples are fitted together.
+    def __init__(self, annotations: Annotations, weights: Optional[np.ndarray] = None):
+        self.n_dims, self.n_users, self.n_annotators = len(DIMS), annotations.n_users, annotations.n_annotators
+        self.weights = np.ones((1, self.n_users)) if weights is None else weights.astype(np.float64)
+        self.n_replicates = len(self.weights)
+        self.users = annotations.users
+        self.dims, self.categories = annotations.dims.astype(np.intp), annotations.categories.astype(np.intp)
+        self.bins = (
+            self.dims * self.n_annotators + annotations.annotators
+        ) * 4 + self.categories  # (dims, annotators, 4)
+        self.user_bins = self.dims * self.n_users + self.users  # Into (dims, users)
+        # The same flat indices of every replicate, into (replicates, dims, annotators, 4) and (replicates, dims, users)
+        replicates = np.arange(self.n_replicates)[:, None]
+        self.replicate_bins = (replicates * self.n_dims * self.n_annotators * 4 + self.bins).ravel()
+        self.replicate_user_bins = (replicates * self.n_dims * self.n_users + self.user_bins).ravel()
+        self.label_weights = self.weights[:, self.users]  # (replicates, labels)
+
+    def initialize(self, normalize: bool = False) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        # Confusion matrices and priors from the median label of every user, and the posteriors they imply.
+        # Users without labels start at 0.5. The rows of the matrices do not sum to 1, as the soft labels of MbtiBench
+        # were computed, unless normalize is set.
+        n_replicates, n_dims, n_users, n_annotators = self.n_replicates, self.n_dims, self.n_users, self.n_annotators
+        categories = self.categories
+        order = np.lexsort((categories, self.user_bins))
+        n_labels = np.bincount(self.user_bins, minlength=n_dims * n_users)
+        starts = np.cumsum(n_labels) - n_labels
+        labelled = n_labels > 0
+        z_init = np.full(n_dims * n_users, -1)
+        z_init[labelled] = categories[order[starts[labelled] + n_labels[labelled] // 2]]
+
+        init_bins = (
+            self.replicate_bins.reshape(n_replicates, -1) - categories + z_init[self.user_bins]
+        ) * 4 + categories
+        count_matrix = np.bincount(
+            init_bins.ravel(), weights=self.label_weights.ravel(), minlength=n_replicates * n_dims * n_annotators * 16
+        ).reshape(n_replicates, n_dims, n_annotators, 4, 4)
+        count_matrix += 1  # Smoothing
+
+        counts = count_matrix.sum(axis=(2, 4))
+        priors = counts / counts.sum(axis=2, keepdims=True)
+        PE = priors[..., 0] + priors[..., 1]
+        PI = priors[..., 2] + priors[..., 3]
+        matrix = np.zeros((n_replicates, n_dims, n_annotators, 2, 4))
+        matrix[:, :, :, 0] = (
+            (count_matrix[:, :, :, 0] * priors[:, :, 0, None, None])
+            + (count_matrix[:, :, :, 1] * priors[:, :, 1, None, None])
+        ) / PE[:, :, None, None]
+        matrix[:, :, :, 1] = (
+            (count_matrix[:, :, :, 2] * priors[:, :, 2, None, None])
+            + (count_matrix[:, :, :, 3] * priors[:, :, 3, None, None])
+        ) / PI[:, :, None, None]
+        if normalize:
+            matrix = _normalize_rows(matrix)
+        previous_posteriors = np.where(z_init < 0, 0.5, z_init < 2).reshape(n_dims, n_users)
+        return matrix, PE, np.broadcast_to(previous_posteriors, (n_replicates, n_dims, n_users))
+
+    def e_step(self, matrix: np.ndarray, PE: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        # Posteriors P(first letter) (replicates, dims, users) and observed-data log-likelihoods (replicates, dims).
+        # Log-likelihoods are summed per user, so many annotators do not underflow the product. Users without labels
+        # get the prior.
+        shape, size = (self.n_replicates, self.n_dims, self.n_users), self.n_replicates * self.n_dims * self.n_users
+        with np.errstate(divide="ignore", invalid="ignore"):
+            log_matrix = np.log(matrix)
+            log_e, log_i = [
+                np.bincount(
+                    self.replicate_user_bins,
+                    weights=log_matrix[:, :, :, k].reshape(self.n_replicates, -1).take(self.bins, axis=1).ravel(),
+                    minlength=size,
+                ).reshape(shape)
+                for k in range(2)
+            ]
+            log_e = log_e + np.log(PE)[:, :, None]
+            log_i = log_i + np.log(1 - PE)[:, :, None]
+            log_total = np.logaddexp(log_e, log_i)
+            posteriors = np.exp(log_e - log_total)
+            log_likelihood = np.where(self.weights[:, None, :] > 0, log_total * self.weights[:, None, :], 0).sum(axis=2)
+        return np.where(np.isnan(posteriors), 0.0, posteriors), log_likelihood  # NaN: both likelihoods are 0
+
+    def m_step(self, posteriors: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        # Row-normalized expected label counts per annotator, and the share of users more likely of the first letter
+        shape = (self.n_replicates, self.n_dims, self.n_annotators, 4)
+        label_posteriors = posteriors.reshape(self.n_replicates, -1).take(self.user_bins, axis=1)
+        matrix = np.stack(
+            [
+                np.bincount(self.replicate_bins, weights=weights.ravel(), minlength=np.prod(shape)).reshape(shape)
+                for weights in [label_posteriors * self.label_weights, (1 - label_posteriors) * self.label_weights]
+            ],
+            axis=3,
+        )
+        row_sum = matrix.sum(axis=4, keepdims=True)
+        matrix = np.divide(matrix, row_sum, out=matrix, where=row_sum > 0)
+        return matrix, self.get_prior(posteriors)
+
+    def get_prior(self, posteriors: np.ndarray) -> np.ndarray:
+        # Share of users more likely of the first letter, the prior update of the soft labels of MbtiBench
+        return ((posteriors > 0.5) * self.weights[:, None, :]).sum(axis=2) / self.weights.sum(axis=1)[:, None]
+
+    def get_change(self, posteriors: np.ndarray, previous_posteriors: np.ndarray) -> np.ndarray:
+        # (replicates, dims) largest posterior change over the users of each replicate
+        change = np.where(self.weights[:, None, :] > 0, np.abs(posteriors - previous_posteriors), 0)
+        return change.max(axis=2, initial=0)
+
+
+def _normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    # Rows of confusion matrices summing to 1, rows without any label stay 0
+    row_sum = matrix.sum(axis=-1, keepdims=True)
+    return np.divide(matrix, row_sum, out=np.zeros_like(matrix), where=row_sum > 0)
+
+
+def _extrapolate(matrix: np.ndarray, matrix_1: np.ndarray, matrix_2: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    # SQUAREM (Varadhan & Roland, 2008) step from two EM steps, projected back onto row-normalized matrices.
+    # Returns the extrapolated matrices and the step length per replicate and dimension, -1 is a plain double EM step.
+    r, v = matrix_1 - matrix, matrix_2 - 2 * matrix_1 + matrix
+    r_norm, v_norm = np.sqrt(np.square(r).sum(axis=(2, 3, 4))), np.sqrt(np.square(v).sum(axis=(2, 3, 4)))
+    step = np.minimum(-np.divide(r_norm, v_norm, out=np.ones_like(r_norm), where=v_norm > 0), -1)
+    extrapolated = np.clip(
+        matrix - 2 * step[..., None, None, None] * r + np.square(step)[..., None, None, None] * v, 0, None
     )
-    mid_combination = ("MID", 0.5, 0)
-    final_results_with_freq.insert(mid_index, mid_combination)
-
-    # Split and calculate cumulative frequencies
-    left_combinations = final_results_with_freq[:mid_index]
-    right_combinations = final_results_with_freq[mid_index + 1 :]
-    cumulative_frequencies_left = []
-    cumulative_frequencies_right = []
-
-    # Left cumulative frequencies
-    previous_value = 0
-    for freq in reversed([item[2] for item in left_combinations]):
-        cumulative_value = previous_value + freq
-        averaged_value = (previous_value + cumulative_value) / 2
-        cumulative_frequencies_left.append(averaged_value)
-        previous_value = cumulative_value
-    cumulative_frequencies_left = cumulative_frequencies_left[::-1]
-
-    # Right cumulative frequencies
-    previous_value = 0
-    for freq in [item[2] for item in right_combinations]:
-        cumulative_value = previous_value + freq
-        averaged_value = (previous_value + cumulative_value) / 2
-        cumulative_frequencies_right.append(averaged_value)
-        previous_value = cumulative_value
-
-    # Normalize cumulative frequencies
-    max_left = max(cumulative_frequencies_left) if cumulative_frequencies_left else 1
-    max_right = max(cumulative_frequencies_right) if cumulative_frequencies_right else 1
-    normalized_frequencies_left = [0.5 - (x / (2 * max_left)) for x in cumulative_frequencies_left]
-    normalized_frequencies_right = [(x / (2 * max_right)) + 0.5 for x in cumulative_frequencies_right]
-
-    # Combine normalized frequencies
-    combined_combinations = [item[0] for item in final_results_with_freq]
-    normalized_combined_frequencies = normalized_frequencies_left + [0.5] + normalized_frequencies_right
-
-    return combined_combinations, normalized_combined_frequencies
-
-
-def processsn(file_paths, tolerance, max_iterations):
-    list1, list2, list3 = [], [], []
-
-    # Read data from provided file paths
-    # for file_path in file_paths:
-    #     df = pd.read_excel(file_path)
-    #     list1.extend(df.get('SNWXH', []).tolist())
-    #     list2.extend(df.get('SNWJM', []).tolist())
-    #     list3.extend(df.get('SNTSY', []).tolist())
-    for file_path in file_paths:
-        with open(file_path, "r", encoding="utf-8") as f:
-            for line in f:
-                data = json.loads(line)
-                annotation = data.get("annotation", {}).get("S/N", {})
-                list1.append(annotation.get("A1", ""))  # 获取 A1 的 E/I 标签
-                list2.append(annotation.get("A2", ""))  # 获取 A2 的 E/I 标签
-                list3.append(annotation.get("A3", ""))  # 获取 A3 的 E/I 标签
-    # Mapping categories to numerical values
-    category_mapping = {"S+": 0, "S-": 1, "N-": 2, "N+": 3}
-    z_init = []
-
-    # Determine the middle value based on the sorted mapped values
-    for i in range(len(list1)):
-        mapped_values = [category_mapping[list1[i]], category_mapping[list2[i]], category_mapping[list3[i]]]
-        middle_mapped_value = sorted(mapped_values)[1]
-        original_category = [key for key, value in category_mapping.items() if value == middle_mapped_value][0]
-        z_init.append(original_category)
-
-    # Initialize count matrix
-    matrix_size = len(category_mapping)
-    count_matrix = np.zeros((3, matrix_size, matrix_size), dtype=int)
-
-    # Populate count matrix with category data
-    for i in range(len(list1)):
-        cat1 = category_mapping[list1[i]]
-        cat2 = category_mapping[list2[i]]
-        cat3 = category_mapping[list3[i]]
-        z_cat = category_mapping[z_init[i]]
-        count_matrix[0, z_cat, cat1] += 1
-        count_matrix[1, z_cat, cat2] += 1
-        count_matrix[2, z_cat, cat3] += 1
-
-    # Add smoothing by incrementing all values by 1
-    count_matrix += 1
-
-    # Calculate counts and probabilities
-    count0 = np.sum(count_matrix[:, 0, :])
-    count1 = np.sum(count_matrix[:, 1, :])
-    count2 = np.sum(count_matrix[:, 2, :])
-    count3 = np.sum(count_matrix[:, 3, :])
-    count = count0 + count1 + count2 + count3
-    PE1, PE2 = count0 / count, count1 / count
-    PI1, PI2 = count2 / count, count3 / count
-    PE = PE1 + PE2
-    PI = PI1 + PI2
-
-    # Function to get probability values
-    def get_pr_values(value, matrix, index):
-        if value == "S+":
-            return matrix[index][0][0], matrix[index][1][0]
-        elif value == "S-":
-            return matrix[index][0][1], matrix[index][1][1]
-        elif value == "N-":
-            return matrix[index][0][2], matrix[index][1][2]
-        elif value == "N+":
-            return matrix[index][0][3], matrix[index][1][3]
-
-    # Initialize the result based on categories
-    initial_resultes = [1 if z in ["S+", "S-"] else 0 for z in z_init]
-
-    # Create a new matrix to update probabilities
-    new_matrix = np.zeros((3, 2, 4))
-    for i in range(3):
-        new_matrix[i, 0] = ((count_matrix[i, 0] * PE1) + (count_matrix[i, 1] * PE2)) / PE
-        new_matrix[i, 1] = ((count_matrix[i, 2] * PI1) + (count_matrix[i, 3] * PI2)) / PI
-
-    iteration = 0
-    previous_resultes = initial_resultes
-
-    # Function to calculate result probabilities
-    def calculate_resulte(list1, list2, list3, matrix, PE, PI):
-        resultes = []
-        for i in range(len(list1)):
-            pr1e, pr1i = get_pr_values(list1[i], matrix, 0)
-            pr2e, pr2i = get_pr_values(list2[i], matrix, 1)
-            pr3e, pr3i = get_pr_values(list3[i], matrix, 2)
-            product_e = pr1e * pr2e * pr3e * PE
-            product_i = pr1i * pr2i * pr3i * PI
-            total = product_e + product_i
-            resulte = product_e / (total if total != 0 else 1)
-            resultes.append(resulte)
-        return resultes
-
-    # Iteratively update results until convergence or reaching max iterations
-    while iteration < max_iterations:
-        resultes = calculate_resulte(list1, list2, list3, new_matrix, PE, PI)
-        PE = sum([1 for r in resultes if r > 0.5]) / len(resultes)
-        PI = 1 - PE
-        diff = np.abs(np.array(resultes) - np.array(previous_resultes)).max()
-        if diff < tolerance:
+    return _normalize_rows(extrapolated), step
+
+
+def _fit(
+    em: _EM,
+    matrix: np.ndarray,
+    PE: np.ndarray,
+    previous_posteriors: np.ndarray,
+    tolerance: float,
+    max_iterations: int,
+    log_likelihood_tolerance: Optional[float],
+    squarem: bool,
+    diagnostics: Optional[List[Dict]],
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # EM iterations of every replicate and dimension, see run_em
+    previous_log_likelihood = np.full(PE.shape, -np.inf)
+    active = np.ones(PE.shape, dtype=bool)
+    for iteration in range(1, max_iterations + 1):
+        posteriors, log_likelihood = em.e_step(matrix, PE)
+        if iteration == 1 and not squarem:
+            # The posteriors come from the unnormalized start, see _EM.initialize, its likelihood is meaningless
+            log_likelihood = em.e_step(_normalize_rows(matrix), PE)[1]
+        if not squarem:
+            # Updated before the convergence check, as the soft labels of MbtiBench were computed
+            PE = np.where(active, em.get_prior(posteriors), PE)
+
+        change = em.get_change(posteriors, previous_posteriors)
+        if log_likelihood_tolerance is None:
+            converged = change < tolerance
+        else:
+            with np.errstate(invalid="ignore"):
+                relative_change = np.abs(log_likelihood - previous_log_likelihood) / np.abs(log_likelihood)
+            # Posteriors that did not move at all are a fixed point, e.g. a warm start on unchanged labels
+            converged = (relative_change < log_likelihood_tolerance) | (change == 0)
+        active &= ~converged
+        previous_posteriors, previous_log_likelihood = posteriors, log_likelihood
+
+        step = None
+        if active.any():
+            new_matrix, new_PE = em.m_step(posteriors)
+            if squarem:
+                matrix_2, PE_2 = em.m_step(em.e_step(new_matrix, new_PE)[0])
+                extrapolated, step = _extrapolate(matrix, new_matrix, matrix_2)
+                extrapolated_posteriors, extrapolated_log_likelihood = em.e_step(extrapolated, PE_2)
+                # Stabilized with one more EM step, falling back to the double EM step if the likelihood dropped
+                accepted = extrapolated_log_likelihood >= log_likelihood
+                new_matrix, new_PE = em.m_step(extrapolated_posteriors)
+                new_matrix = np.where(accepted[..., None, None, None], new_matrix, matrix_2)
+                new_PE = np.where(accepted, new_PE, PE_2)
+                PE = np.where(active, new_PE, PE)
+            matrix = np.where(active[..., None, None, None], new_matrix, matrix)
+
+        if diagnostics is not None:
+            diagnostics.append(
+                {
+                    "iteration": iteration,
+                    "log_likelihood": log_likelihood,
+                    "max_change": change,
+                    "step": step,
+                    "active": active.copy(),
+                }
+            )
+        if not active.any():
             break
-        previous_resultes = resultes
-
-        # Update count matrix with new results
-        new_count_matrix = np.zeros((3, 2, 4), dtype=float)
-        for i in range(len(list1)):
-            cat1 = category_mapping[list1[i]]
-            cat2 = category_mapping[list2[i]]
-            cat3 = category_mapping[list3[i]]
-            new_count_matrix[0, 0, cat1] += resultes[i]
-            new_count_matrix[0, 1, cat1] += 1 - resultes[i]
-            new_count_matrix[1, 0, cat2] += resultes[i]
-            new_count_matrix[1, 1, cat2] += 1 - resultes[i]
-            new_count_matrix[2, 0, cat3] += resultes[i]
-            new_count_matrix[2, 1, cat3] += 1 - resultes[i]
-
-        # Normalize the new matrix
-        new_matrix = np.copy(new_count_matrix)
-        for layer in range(new_matrix.shape[0]):
-            for row in range(new_matrix.shape[1]):
-                row_sum = np.sum(new_matrix[layer, row])
-                if row_sum > 0:
-                    new_matrix[layer, row] = new_matrix[layer, row] / row_sum
-
-        iteration += 1
-
-    # Final results calculation
-    final_results = []
-    for i in range(len(list1)):
-        pr1e, pr1i = get_pr_values(list1[i], new_matrix, 0)
-        pr2e, pr2i = get_pr_values(list2[i], new_matrix, 1)
-        pr3e, pr3i = get_pr_values(list3[i], new_matrix, 2)
-        product_e = pr1e * pr2e * pr3e * PE
-        product_i = pr1i * pr2i * pr3i * PI
-        total = product_e + product_i
-        resulte = product_e / total
-        combination = f"{list1[i]}{list2[i]}{list3[i]}"
-        final_results.append((combination, resulte))
-
-    # Deduplicate and sort final results
-    final_results = list(set(final_results))
-    final_results.sort(key=lambda x: x[1], reverse=True)
-
-    # Frequency analysis of combinations
-    frequency_dict = {}
-    for i in range(len(list1)):
-        combination = f"{list1[i]}{list2[i]}{list3[i]}"
-        frequency_dict[combination] = frequency_dict.get(combination, 0) + 1
-
-    final_results_with_freq = [
-        (combination, resulte, frequency_dict.get(combination, 0)) for combination, resulte in final_results
-    ]
-
-    # Sort results and find the median
-    final_results_with_freq.sort(key=lambda x: x[1])
-    mid_index = next(
-        (i for i, item in enumerate(final_results_with_freq) if item[1] >= 0.5), len(final_results_with_freq)
+
+    return em.e_step(matrix, PE)[0], matrix, PE
+
+
+def run_em(
+    annotations: Annotations,
+    tolerance: float,
+    max_iterations: int,
+    log_likelihood_tolerance: Optional[float] = None,
+    squarem: bool = False,
+    diagnostics: Optional[List[Dict]] = None,
+    init: Optional[Tuple[np.ndarray, np.ndarray]] = None,
+    fitted_users: Optional[np.ndarray] = None,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # EM of all dimensions at once, each dimension stops on its own: once the relative change of its log-likelihood
+    # is below log_likelihood_tolerance if given, otherwise once no posterior moves by tolerance. With squarem, every
+    # iteration extrapolates from two EM steps, which reaches tight tolerances in far fewer iterations, starting from
+    # normalized matrices so that its likelihood comparisons hold from the first iteration.
+    # Returns the posteriors P(first letter) (dims, users), per-annotator confusion matrices (dims, annotators, 2, 4)
+    # and the priors P(first letter) (dims,). Per-iteration log-likelihoods, posterior changes and SQUAREM step
+    # lengths are appended to diagnostics.
+    # init warm-starts from saved (matrix, PE), see load_state; annotators without saved rows (NaN) start from the
+    # median labels like a cold start. fitted_users (users,) marks users with the same labels as when init was
+    # fitted: their posteriors under init count as the previous iteration, so an unchanged dataset stops at once.
+    em = _EM(annotations)
+    matrix, PE, previous_posteriors = em.initialize(normalize=squarem)
+    if init is not None:
+        init_matrix, PE = init[0][None], init[1][None]
+        matrix = np.where(np.isnan(init_matrix), matrix, init_matrix)
+        if fitted_users is not None:
+            previous_posteriors = np.where(fitted_users, em.e_step(matrix, PE)[0], previous_posteriors)
+
+    records: Optional[List[Dict]] = [] if diagnostics is not None else None
+    posteriors, matrix, PE = _fit(
+        em, matrix, PE, previous_posteriors, tolerance, max_iterations, log_likelihood_tolerance, squarem, records
     )
-    mid_combination = ("MID", 0.5, 0)
-    final_results_with_freq.insert(mid_index, mid_combination)
-
-    # Split and calculate cumulative frequencies
-    left_combinations = final_results_with_freq[:mid_index]
-    right_combinations = final_results_with_freq[mid_index + 1 :]
-    cumulative_frequencies_left = []
-    cumulative_frequencies_right = []
-
-    # Left cumulative frequencies
-    previous_value = 0
-    for freq in reversed([item[2] for item in left_combinations]):
-        cumulative_value = previous_value + freq
-        averaged_value = (previous_value + cumulative_value) / 2
-        cumulative_frequencies_left.append(averaged_value)
-        previous_value = cumulative_value
-    cumulative_frequencies_left = cumulative_frequencies_left[::-1]
-
-    # Right cumulative frequencies
-    previous_value = 0
-    for freq in [item[2] for item in right_combinations]:
-        cumulative_value = previous_value + freq
-        averaged_value = (previous_value + cumulative_value) / 2
-        cumulative_frequencies_right.append(averaged_value)
-        previous_value = cumulative_value
-
-    # Normalize cumulative frequencies
-    max_left = max(cumulative_frequencies_left) if cumulative_frequencies_left else 1
-    max_right = max(cumulative_frequencies_right) if cumulative_frequencies_right else 1
-    normalized_frequencies_left = [0.5 - (x / (2 * max_left)) for x in cumulative_frequencies_left]
-    normalized_frequencies_right = [(x / (2 * max_right)) + 0.5 for x in cumulative_frequencies_right]
-
-    # Combine normalized frequencies
-    combined_combinations = (
-        [item[0] for item in left_combinations] + [mid_combination[0]] + [item[0] for item in right_combinations]
+    if diagnostics is not None:
+        for record in records:
+            diagnostics.append(
+                {key: value[0].tolist() if isinstance(value, np.ndarray) else value for key, value in record.items()}
+            )
+    return posteriors[0], matrix[0], PE[0]
+
+
+def run_bootstrap_em(
+    annotations: Annotations,
+    n_resamples: int,
+    seed: int = 0,
+    tolerance: float = 1e-1,
+    max_iterations: int = 10000,
+    log_likelihood_tolerance: Optional[float] = None,
+    squarem: bool = False,
+) -> Tuple[np.ndarray, np.ndarray]:
+    # EM fits of n_resamples resamples of the users, drawn with replacement and fitted together as one batch of
+    # replicates. Returns the posteriors (resamples, dims, users) of every user under every fit, and the weights
+    # (resamples, users), the number of times each user was drawn.
+    rng = np.random.default_rng(seed)
+    draws = rng.integers(0, annotations.n_users, size=(n_resamples, annotations.n_users))
+    draws += np.arange(n_resamples)[:, None] * annotations.n_users
+    weights = np.bincount(draws.ravel(), minlength=n_resamples * annotations.n_users).reshape(n_resamples, -1)
+
+    em = _EM(annotations, weights)
+    matrix, PE, previous_posteriors = em.initialize(normalize=squarem)
+    posteriors, _, _ = _fit(
+        em, matrix, PE, previous_posteriors, tolerance, max_iterations, log_likelihood_tolerance, squarem, None
     )
-    combined_frequencies = normalized_frequencies_left + [mid_combination[2]] + normalized_frequencies_right
-
-    # Filter out the 'MID' combination
-    filtered_combinations = [comb for comb in combined_combinations if comb != "MID"]
-    filtered_frequencies = [freq for comb, freq in zip(combined_combinations, combined_frequencies) if comb != "MID"]
-
-    # Sort combined results by frequency
-    sorted_results = sorted(zip(filtered_combinations, filtered_frequencies), key=lambda x: x[1])
-    sorted_combinations, sorted_frequencies = zip(*sorted_results) if sorted_results else ([], [])
-
-    # Plot the results
-    plt.figure(figsize=(12, 8))
-    bars = plt.bar(sorted_combinations, sorted_frequencies, color="skyblue")
-
-    # Add title and labels
-    plt.axhline(y=0.5, color="r", linestyle="--", label="Result = 0.5")
-    plt.xlabel("Combination", fontsize=20)
-    plt.ylabel("Soft Label", fontsize=20)
-
-    # Rotate x-axis labels for readability
-    plt.xticks(rotation=90, fontsize=20)
-    plt.yticks(rotation=0, fontsize=20)
-
-    # Adjust layout to prevent clipping
-    plt.tight_layout()
-
-    # Save and show plot
-    output_path = "./SN_F.png"
-    # plt.savefig(output_path)
-    # plt.show()
-
-    return sorted_combinations, sorted_frequencies
-
-
-def processtf(file_paths, tolerance, max_iterations):
-    # Initialize lists to store data from each column
-    list1, list2, list3 = [], [], []
-
-    # Read data from the provided file paths and extend lists
-    # for file_path in file_paths:
-    #     df = pd.read_excel(file_path)
-    #     list1.extend(df.get('TFWXH', []).tolist())
-    #     list2.extend(df.get('TFWJM', []).tolist())
-    #     list3.extend(df.get('TFTSY', []).tolist())
-    for file_path in file_paths:
-        with open(file_path, "r", encoding="utf-8") as f:
-            for line in f:
-                data = json.loads(line)
-                annotation = data.get("annotation", {}).get("T/F", {})
-                list1.append(annotation.get("A1", ""))  # 获取 A1 的 E/I 标签
-                list2.append(annotation.get("A2", ""))  # 获取 A2 的 E/I 标签
-                list3.append(annotation.get("A3", ""))  # 获取 A3 的 E/I 标签
-    # Map the categories to numerical values
-    category_mapping = {"T+": 0, "T-": 1, "F-": 2, "F+": 3}
-    z_init = []
-
-    # Determine the middle value based on sorted mapped values
-    for i in range(len(list1)):
-        mapped_values = [category_mapping[list1[i]], category_mapping[list2[i]], category_mapping[list3[i]]]
-        middle_mapped_value = sorted(mapped_values)[1]
-        original_category = [key for key, value in category_mapping.items() if value == middle_mapped_value][0]
-        z_init.append(original_category)
-
-    # Initialize the count matrix for counts across categories
-    matrix_size = len(category_mapping)
-    count_matrix = np.zeros((3, matrix_size, matrix_size), dtype=int)
-
-    # Populate count matrix with category data
-    for i in range(len(list1)):
-        cat1 = category_mapping[list1[i]]
-        cat2 = category_mapping[list2[i]]
-        cat3 = category_mapping[list3[i]]
-        z_cat = category_mapping[z_init[i]]
-        count_matrix[0, z_cat, cat1] += 1
-        count_matrix[1, z_cat, cat2] += 1
-        count_matrix[2, z_cat, cat3] += 1
-
-    # Add smoothing by incrementing all values by 1
-    count_matrix += 1
-
-    # Calculate counts and probabilities for each category
-    count0 = np.sum(count_matrix[:, 0, :])
-    count1 = np.sum(count_matrix[:, 1, :])
-    count2 = np.sum(count_matrix[:, 2, :])
-    count3 = np.sum(count_matrix[:, 3, :])
-    count = count0 + count1 + count2 + count3
-    PE1, PE2 = count0 / count, count1 / count
-    PI1, PI2 = count2 / count, count3 / count
-    PE = PE1 + PE2
-    PI = PI1 + PI2
-
-    # Helper function to retrieve probability values based on category
-    def get_pr_values(value, matrix, index):
-        if value == "T+":
-            return matrix[index][0][0], matrix[index][1][0]
-        elif value == "T-":
-            return matrix[index][0][1], matrix[index][1][1]
-        elif value == "F-":
-            return matrix[index][0][2], matrix[index][1][2]
-        elif value == "F+":
-            return matrix[index][0][3], matrix[index][1][3]
-
-    # Initialize results based on category
-    initial_resultes = [1 if z in ["T+", "T-"] else 0 for z in z_init]
-
-    # Create a new matrix to update probabilities
-    new_matrix = np.zeros((3, 2, 4))
-    for i in range(3):
-        new_matrix[i, 0] = ((count_matrix[i, 0] * PE1) + (count_matrix[i, 1] * PE2)) / PE
-        new_matrix[i, 1] = ((count_matrix[i, 2] * PI1) + (count_matrix[i, 3] * PI2)) / PI
-
-    iteration = 0
-    previous_resultes = initial_resultes
-
-    # Calculate result probabilities for each iteration
-    def calculate_resulte(list1, list2, list3, matrix, PE, PI):
-        resultes = []
-        for i in range(len(list1)):
-            pr1e, pr1i = get_pr_values(list1[i], matrix, 0)
-            pr2e, pr2i = get_pr_values(list2[i], matrix, 1)
-            pr3e, pr3i = get_pr_values(list3[i], matrix, 2)
-            product_e = pr1e * pr2e * pr3e * PE
-            product_i = pr1i * pr2i * pr3i * PI
-            total = product_e + product_i
-            resulte = product_e / (total if total != 0 else 1)
-            resultes.append(resulte)
-        return resultes
-
-    # Iteratively update results until convergence or reaching max iterations
-    while iteration < max_iterations:
-        resultes = calculate_resulte(list1, list2, list3, new_matrix, PE, PI)
-        PE = sum([1 for r in resultes if r > 0.5]) / len(resultes)
-        PI = 1 - PE
-        diff = np.abs(np.array(resultes) - np.array(previous_resultes)).max()
-        if diff < tolerance:
-            break
-        previous_resultes = resultes
-
-        # Update the count matrix based on new results
-        new_count_matrix = np.zeros((3, 2, 4), dtype=float)
-        for i in range(len(list1)):
-            cat1 = category_mapping[list1[i]]
-            cat2 = category_mapping[list2[i]]
-            cat3 = category_mapping[list3[i]]
-            new_count_matrix[0, 0, cat1] += resultes[i]
-            new_count_matrix[0, 1, cat1] += 1 - resultes[i]
-            new_count_matrix[1, 0, cat2] += resultes[i]
-            new_count_matrix[1, 1, cat2] += 1 - resultes[i]
-            new_count_matrix[2, 0, cat3] += resultes[i]
-            new_count_matrix[2, 1, cat3] += 1 - resultes[i]
-
-        # Normalize the new matrix
-        new_matrix = np.copy(new_count_matrix)
-        for layer in range(new_matrix.shape[0]):
-            for row in range(new_matrix.shape[1]):
-                row_sum = np.sum(new_matrix[layer, row])
-                if row_sum > 0:
-                    new_matrix[layer, row] = new_matrix[layer, row] / row_sum
-
-        iteration += 1
-
-    # Calculate the final results
-    final_results = []
-    for i in range(len(list1)):
-        pr1e, pr1i = get_pr_values(list1[i], new_matrix, 0)
-        pr2e, pr2i = get_pr_values(list2[i], new_matrix, 1)
-        pr3e, pr3i = get_pr_values(list3[i], new_matrix, 2)
-        product_e = pr1e * pr2e * pr3e * PE
-        product_i = pr1i * pr2i * pr3i * PI
-        total = product_e + product_i
-        resulte = product_e / total
-        combination = f"{list1[i]}{list2[i]}{list3[i]}"
-        final_results.append((combination, resulte))
-
-    # Remove duplicates and sort results
-    final_results = list(set(final_results))
-    final_results.sort(key=lambda x: x[1], reverse=True)
-
-    # Perform frequency analysis of combinations
-    frequency_dict = {}
-    for i in range(len(list1)):
-        combination = f"{list1[i]}{list2[i]}{list3[i]}"
-        frequency_dict[combination] = frequency_dict.get(combination, 0) + 1
-
-    # Prepare results with frequency
-    final_results_with_freq = [
-        (combination, resulte, frequency_dict.get(combination, 0)) for combination, resulte in final_results
-    ]
-
-    # Sort results by soft label value
-    final_results_with_freq.sort(key=lambda x: x[1])
-
-    # Find and insert the median value (resulte = 0.5)
-    mid_index = next(
-        (i for i, item in enumerate(final_results_with_freq) if item[1] >= 0.5), len(final_results_with_freq)
+    return posteriors, weights
+
+
+def _get_patterns(annotations: Annotations, d: int) -> np.ndarray:
+    # (users, max labels per user) annotator * 4 + category of every label of a dimension, padded with -1, or one key
+    # per user encoding the same
+    start, end = np.searchsorted(annotations.dims, [d, d + 1])
+    users = annotations.users[start:end]
+    tokens = annotations.annotators[start:end] * 4 + annotations.categories[start:end]
+    n_labels = np.bincount(users, minlength=annotations.n_users)
+    positions = np.arange(len(users)) - (np.cumsum(n_labels) - n_labels)[users]
+    patterns = np.full((annotations.n_users, max(n_labels.max(initial=0), 1)), -1, dtype=np.int32)
+    patterns[users, positions] = tokens
+
+    # One int64 key per user when the patterns fit, np.unique on rows is much slower
+    base, width = 4 * annotations.n_annotators + 1, patterns.shape[1]
+    if base**width < 2**63:
+        return ((patterns + 1).astype(np.int64) * base ** np.arange(width - 1, -1, -1, dtype=np.int64)).sum(axis=1)
+    return patterns
+
+
+def _get_combination_softlabels(
+    annotations: Annotations, d: int, posteriors: np.ndarray, weights: Optional[np.ndarray] = None
+) -> Tuple[np.ndarray, np.ndarray]:
+    # Soft labels (replicates, combinations) of a dimension and the combination of every user. Users given the same
+    # labels by the same annotators form one combination; combinations are ranked by posterior and spread over
+    # [0, 0.5) and (0.5, 1] by the midpoints of their cumulative frequencies, counted outwards from 0.5.
+    # posteriors is (replicates, users), weights (replicates, users) counts users in bootstrap resamples.
+    patterns = _get_patterns(annotations, d)
+    _, first_index, inverse, counts = np.unique(
+        patterns, axis=0 if patterns.ndim == 2 else None, return_index=True, return_inverse=True, return_counts=True
     )
-    mid_combination = ("MID", 0.5, 0)
-    final_results_with_freq.insert(mid_index, mid_combination)
-
-    # Split the results into left and right of 0.5
-    left_combinations = final_results_with_freq[:mid_index]
-    right_combinations = final_results_with_freq[mid_index + 1 :]
-
-    # Calculate cumulative frequencies for both left and right sides
-    cumulative_frequencies_left = []
-    cumulative_frequencies_right = []
-
-    # Calculate cumulative frequencies for the left side
-    previous_value = 0
-    for freq in reversed([item[2] for item in left_combinations]):
-        cumulative_value = previous_value + freq
-        averaged_value = (previous_value + cumulative_value) / 2
-        cumulative_frequencies_left.append(averaged_value)
-        previous_value = cumulative_value
-    cumulative_frequencies_left = cumulative_frequencies_left[::-1]
-
-    # Calculate cumulative frequencies for the right side
-    previous_value = 0
-    for freq in [item[2] for item in right_combinations]:
-        cumulative_value = previous_value + freq
-        averaged_value = (previous_value + cumulative_value) / 2
-        cumulative_frequencies_right.append(averaged_value)
-        previous_value = cumulative_value
-
-    # Normalize cumulative frequencies for plotting
-    max_left = max(cumulative_frequencies_left) if cumulative_frequencies_left else 1
-    max_right = max(cumulative_frequencies_right) if cumulative_frequencies_right else 1
-    normalized_frequencies_left = [0.5 - (x / (2 * max_left)) for x in cumulative_frequencies_left]
-    normalized_frequencies_right = [(x / (2 * max_right)) + 0.5 for x in cumulative_frequencies_right]
-
-    # Combine combinations and their frequencies for plotting
-    combined_combinations = (
-        [item[0] for item in left_combinations] + [mid_combination[0]] + [item[0] for item in right_combinations]
+    inverse = inverse.ravel()
+    if weights is None:
+        frequencies = np.broadcast_to(counts, (len(posteriors), len(counts)))
+    else:
+        frequencies = np.stack([np.bincount(inverse, weights=w, minlength=len(counts)) for w in weights])
+
+    order = np.argsort(posteriors[:, first_index], axis=1, kind="stable")
+    scores = np.take_along_axis(posteriors[:, first_index], order, axis=1)
+    frequencies = np.take_along_axis(frequencies, order, axis=1)
+    mid_index = (scores < 0.5).sum(axis=1, keepdims=True)
+
+    # Left of 0.5 frequencies are accumulated from mid_index downwards, right of it upwards
+    cumulative = np.concatenate(
+        [np.zeros((len(scores), 1), dtype=frequencies.dtype), np.cumsum(frequencies, axis=1)], axis=1
     )
-    combined_frequencies = normalized_frequencies_left + [mid_combination[2]] + normalized_frequencies_right
-
-    # Filter out the 'MID' combination for plotting
-    filtered_combinations = [comb for comb in combined_combinations if comb != "MID"]
-    filtered_frequencies = [freq for comb, freq in zip(combined_combinations, combined_frequencies) if comb != "MID"]
-
-    # Sort results by frequency for consistency
-    sorted_results = sorted(zip(filtered_combinations, filtered_frequencies), key=lambda x: x[1])
-
-    # Extract sorted combinations and frequencies
-    sorted_combinations, sorted_frequencies = zip(*sorted_results) if sorted_results else ([], [])
-
-    # Plot the normalized cumulative frequencies
-    plt.figure(figsize=(12, 8))
-    bars = plt.bar(sorted_combinations, sorted_frequencies, color="skyblue")
-
-    # Add title and labels
-    plt.axhline(y=0.5, color="r", linestyle="--", label="Result = 0.5")
-    plt.xlabel("Combination", fontsize=20)
-    plt.ylabel("Soft Label", fontsize=20)
-
-    # Rotate x-axis labels for better readability
-    plt.xticks(rotation=90, fontsize=20)
-    plt.yticks(rotation=0, fontsize=20)
+    at_mid = np.take_along_axis(cumulative, mid_index, axis=1)
+    left = ((at_mid - cumulative[:, 1:]) + (at_mid - cumulative[:, :-1])) / 2
+    right = ((cumulative[:, :-1] - at_mid) + (cumulative[:, 1:] - at_mid)) / 2
+    is_left, present = np.arange(scores.shape[1]) < mid_index, frequencies > 0
+    max_left = np.where(is_left & present, left, 0).max(axis=1, keepdims=True)
+    max_right = np.where(~is_left & present, right, 0).max(axis=1, keepdims=True)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        values = np.where(
+            is_left,
+            0.5 - np.where(max_left > 0, left / (2 * max_left), 0),
+            np.where(max_right > 0, right / (2 * max_right), 0) + 0.5,
+        )
+
+    softlabels = np.empty(values.shape)
+    np.put_along_axis(softlabels, order, np.where(present, 1 - values, np.nan), axis=1)  # NaN: not in the resample
+    return softlabels, inverse
+
+
+def get_softlabels(annotations: Annotations, posteriors: np.ndarray) -> np.ndarray:
+    # (dims, users) soft labels P(second letter), see _get_combination_softlabels
+    softlabels = np.zeros((len(DIMS), annotations.n_users))
+    for d in range(len(DIMS)):
+        combination_softlabels, inverse = _get_combination_softlabels(annotations, d, posteriors[None, d])
+        softlabels[d] = combination_softlabels[0, inverse]
+    return softlabels
+
+
+def get_softlabel_intervals(
+    annotations: Annotations, posteriors: np.ndarray, weights: np.ndarray, confidence: float = 0.95
+) -> Tuple[np.ndarray, np.ndarray]:
+    # (dims, users) lower and upper percentile bounds of the soft label of every user's combination over the
+    # bootstrap fits of run_bootstrap_em, over the resamples that contain the combination. NaN for combinations that
+    # no resample contains.
+    low, high = np.zeros((len(DIMS), annotations.n_users)), np.zeros((len(DIMS), annotations.n_users))
+    for d in range(len(DIMS)):
+        combination_softlabels, inverse = _get_combination_softlabels(annotations, d, posteriors[:, d], weights)
+        sampled = ~np.isnan(combination_softlabels).all(axis=0)
+        bounds = np.full((2, combination_softlabels.shape[1]), np.nan)
+        bounds[:, sampled] = np.nanquantile(
+            combination_softlabels[:, sampled], [(1 - confidence) / 2, (1 + confidence) / 2], axis=0
+        )
+        low[d], high[d] = bounds[0, inverse], bounds[1, inverse]
+    return low, high
+
+
+def get_hardlabels(annotations: Annotations, softlabels: np.ndarray) -> np.ndarray:
+    # (dims, users) True for the first letter: the majority label, ties and unlabelled users by soft label
+    user_bins = annotations.dims.astype(np.intp) * annotations.n_users + annotations.users
+    size = len(DIMS) * annotations.n_users
+    n_first = np.bincount(user_bins, weights=annotations.categories < 2, minlength=size).reshape(len(DIMS), -1)
+    n_labels = np.bincount(user_bins, minlength=size).reshape(len(DIMS), -1)
+    return np.where(2 * n_first != n_labels, 2 * n_first > n_labels, softlabels < 0.5)
+
+
+def get_combination_softlabels(dataset: List[Dict], softlabels: np.ndarray, d: int) -> Dict[str, float]:
+    # Soft label per annotation combination of a dimension, e.g. {"A1:I-,A2:I-,A3:I-": 0.81, ...}. Combinations are
+    # told apart by annotator as well, like the patterns the soft labels are spread by, see _get_patterns.
+    return {
+        ",".join(
+            f"{name}:{label}" for name, label in sorted(data["annotation"].get(DIMS[d], {}).items()) if label
+        ): float(softlabels[d, u])
+        for u, data in enumerate(dataset)
+    }
 
-    # Adjust layout to prevent clipping
-    plt.tight_layout()
 
-    # Save and show the plot
-    output_path = "./TF_F.png"
-    # plt.savefig(output_path)
-    # plt.show()
+def save_state(path: str, annotations: Annotations, matrix: np.ndarray, PE: np.ndarray):
+    # Fitted confusion matrices and priors, to warm-start the next fit when annotations are added
+    tmp_path = f"{path}.{os.getpid()}.tmp.npz"
+    np.savez(tmp_path, matrix=matrix, PE=PE, annotator_names=np.array(annotations.annotator_names, dtype=str))
+    os.replace(tmp_path, path)
 
-    return sorted_combinations, sorted_frequencies
 
+def load_state(path: str, annotations: Annotations) -> Tuple[np.ndarray, np.ndarray]:
+    # Saved state aligned to the annotators of annotations by name, rows of new annotators are NaN
+    with np.load(path) as state:
+        saved_index = {name: a for a, name in enumerate(state["annotator_names"].tolist())}
+        matrix = np.full((len(DIMS), annotations.n_annotators, 2, 4), np.nan)
+        for a, name in enumerate(annotations.annotator_names):
+            if name in saved_index:
+                matrix[:, a] = state["matrix"][:, saved_index[name]]
+        return matrix, state["PE"]
 
-def processjp(file_paths, tolerance, max_iterations):
-    # Initialize empty lists to hold the values from the Excel files
-    list1, list2, list3 = [], [], []
 
-    # Loop through each file and extract the specified columns
-    # for file_path in file_paths:
-    #     df = pd.read_excel(file_path)
-    #     list1.extend(df.get('JPWXH', []).tolist())
-    #     list2.extend(df.get('JPWJM', []).tolist())
-    #     list3.extend(df.get('JPTSY', []).tolist())
-    for file_path in file_paths:
-        with open(file_path, "r", encoding="utf-8") as f:
+def load_dataset(path: str) -> Dict[int, Tuple[str, Dict]]:
+    # Raw line and record of every id of a labelled dataset, empty if there is none yet
+    records = {}
+    if os.path.exists(path):
+        with open(path) as f:
             for line in f:
                 data = json.loads(line)
-                annotation = data.get("annotation", {}).get("J/P", {})
-                list1.append(annotation.get("A1", ""))  # 获取 A1 的 E/I 标签
-                list2.append(annotation.get("A2", ""))  # 获取 A2 的 E/I 标签
-                list3.append(annotation.get("A3", ""))  # 获取 A3 的 E/I 标签
-    # Define the mapping of categories to integers
-    category_mapping = {"J+": 0, "J-": 1, "P-": 2, "P+": 3}
-    z_init = []
-
-    # Map each combination of categories to its middle value
-    for i in range(len(list1)):
-        mapped_values = [category_mapping[list1[i]], category_mapping[list2[i]], category_mapping[list3[i]]]
-        middle_mapped_value = sorted(mapped_values)[1]
-        original_category = [key for key, value in category_mapping.items() if value == middle_mapped_value][0]
-        z_init.append(original_category)
-
-    # Initialize count matrix
-    matrix_size = len(category_mapping)
-    count_matrix = np.zeros((3, matrix_size, matrix_size), dtype=int)
-
-    # Populate count matrix with the mapped category values
-    for i in range(len(list1)):
-        cat1 = category_mapping[list1[i]]
-        cat2 = category_mapping[list2[i]]
-        cat3 = category_mapping[list3[i]]
-        z_cat = category_mapping[z_init[i]]
-        count_matrix[0, z_cat, cat1] += 1
-        count_matrix[1, z_cat, cat2] += 1
-        count_matrix[2, z_cat, cat3] += 1
-
-    # Add smoothing to avoid zero counts
-    count_matrix += 1
-
-    # Calculate initial proportions for each category
-    count0 = np.sum(count_matrix[:, 0, :])
-    count1 = np.sum(count_matrix[:, 1, :])
-    count2 = np.sum(count_matrix[:, 2, :])
-    count3 = np.sum(count_matrix[:, 3, :])
-    count = count0 + count1 + count2 + count3
-    PE1, PE2 = count0 / count, count1 / count
-    PI1, PI2 = count2 / count, count3 / count
-    PE = PE1 + PE2
-    PI = PI1 + PI2
-
-    # Function to retrieve PR values based on a category
-    def get_pr_values(value, matrix, index):
-        if value == "J+":
-            return matrix[index][0][0], matrix[index][1][0]
-        elif value == "J-":
-            return matrix[index][0][1], matrix[index][1][1]
-        elif value == "P-":
-            return matrix[index][0][2], matrix[index][1][2]
-        elif value == "P+":
-            return matrix[index][0][3], matrix[index][1][3]
-
-    # Initialize results based on the initial z_init values
-    initial_resultes = [1 if z in ["J+", "J-"] else 0 for z in z_init]
-
-    # Create new matrix with normalized counts for each category
-    new_matrix = np.zeros((3, 2, 4))
-    for i in range(3):
-        new_matrix[i, 0] = ((count_matrix[i, 0] * PE1) + (count_matrix[i, 1] * PE2)) / PE
-        new_matrix[i, 1] = ((count_matrix[i, 2] * PI1) + (count_matrix[i, 3] * PI2)) / PI
-
-    iteration = 0
-    previous_resultes = initial_resultes
-
-    # Function to calculate results for each iteration
-    def calculate_resulte(list1, list2, list3, matrix, PE, PI):
-        resultes = []
-        for i in range(len(list1)):
-            pr1e, pr1i = get_pr_values(list1[i], matrix, 0)
-            pr2e, pr2i = get_pr_values(list2[i], matrix, 1)
-            pr3e, pr3i = get_pr_values(list3[i], matrix, 2)
-            product_e = pr1e * pr2e * pr3e * PE
-            product_i = pr1i * pr2i * pr3i * PI
-            total = product_e + product_i
-            resulte = product_e / (total if total != 0 else 1)
-            resultes.append(resulte)
-        return resultes
-
-    # Iteratively update the results until convergence
-    while iteration < max_iterations:
-        resultes = calculate_resulte(list1, list2, list3, new_matrix, PE, PI)
-        PE = sum([1 for r in resultes if r > 0.5]) / len(resultes)
-        PI = 1 - PE
-        diff = np.abs(np.array(resultes) - np.array(previous_resultes)).max()
-        if diff < tolerance:
-            break
-        previous_resultes = resultes
-
-        # Update the count matrix based on new results
-        new_count_matrix = np.zeros((3, 2, 4), dtype=float)
-        for i in range(len(list1)):
-            cat1 = category_mapping[list1[i]]
-            cat2 = category_mapping[list2[i]]
-            cat3 = category_mapping[list3[i]]
-            new_count_matrix[0, 0, cat1] += resultes[i]
-            new_count_matrix[0, 1, cat1] += 1 - resultes[i]
-            new_count_matrix[1, 0, cat2] += resultes[i]
-            new_count_matrix[1, 1, cat2] += 1 - resultes[i]
-            new_count_matrix[2, 0, cat3] += resultes[i]
-            new_count_matrix[2, 1, cat3] += 1 - resultes[i]
-
-        # Normalize the count matrix
-        new_matrix = np.copy(new_count_matrix)
-        for layer in range(new_matrix.shape[0]):
-            for row in range(new_matrix.shape[1]):
-                row_sum = np.sum(new_matrix[layer, row])
-                if row_sum > 0:
-                    new_matrix[layer, row] = new_matrix[layer, row] / row_sum
-
-        iteration += 1
-
-    # Generate the final results with their frequencies
-    final_results = []
-    for i in range(len(list1)):
-        pr1e, pr1i = get_pr_values(list1[i], new_matrix, 0)
-        pr2e, pr2i = get_pr_values(list2[i], new_matrix, 1)
-        pr3e, pr3i = get_pr_values(list3[i], new_matrix, 2)
-        product_e = pr1e * pr2e * pr3e * PE
-        product_i = pr1i * pr2i * pr3i * PI
-        total = product_e + product_i
-        resulte = product_e / total
-        combination = f"{list1[i]}{list2[i]}{list3[i]}"
-        final_results.append((combination, resulte))
-
-    # Remove duplicates and sort by result value
-    final_results = list(set(final_results))
-    final_results.sort(key=lambda x: x[1], reverse=True)
-
-    # Count the frequency of each combination
-    frequency_dict = {}
-    for i in range(len(list1)):
-        combination = f"{list1[i]}{list2[i]}{list3[i]}"
-        frequency_dict[combination] = frequency_dict.get(combination, 0) + 1
-
-    # Attach frequencies to final results
-    final_results_with_freq = [
-        (combination, resulte, frequency_dict.get(combination, 0)) for combination, resulte in final_results
-    ]
-
-    # Sort results by result value and insert 'MID' at 0.5
-    final_results_with_freq.sort(key=lambda x: x[1])
-    mid_index = next(
-        (i for i, item in enumerate(final_results_with_freq) if item[1] >= 0.5), len(final_results_with_freq)
-    )
-    mid_combination = ("MID", 0.5, 0)
-    final_results_with_freq.insert(mid_index, mid_combination)
-
-    # Separate left and right of 'MID'
-    left_combinations = final_results_with_freq[:mid_index]
-    right_combinations = final_results_with_freq[mid_index + 1 :]
-
-    # Calculate cumulative frequencies for left and right of 'MID'
-    cumulative_frequencies_left = []
-    cumulative_frequencies_right = []
-
-    previous_value = 0
-    for freq in reversed([item[2] for item in left_combinations]):
-        cumulative_value = previous_value + freq
-        averaged_value = (previous_value + cumulative_value) / 2
-        cumulative_frequencies_left.append(averaged_value)
-        previous_value = cumulative_value
-    cumulative_frequencies_left = cumulative_frequencies_left[::-1]
-
-    previous_value = 0
-    for freq in [item[2] for item in right_combinations]:
-        cumulative_value = previous_value + freq
-        averaged_value = (previous_value + cumulative_value) / 2
-        cumulative_frequencies_right.append(averaged_value)
-        previous_value = cumulative_value
-
-    # Normalize the cumulative frequencies
-    max_left = max(cumulative_frequencies_left) if cumulative_frequencies_left else 1
-    max_right = max(cumulative_frequencies_right) if cumulative_frequencies_right else 1
-    normalized_frequencies_left = [0.5 - (x / (2 * max_left)) for x in cumulative_frequencies_left]
-    normalized_frequencies_right = [(x / (2 * max_right)) + 0.5 for x in cumulative_frequencies_right]
-
-    # Combine results for plotting
-    combined_combinations = (
-        [item[0] for item in left_combinations] + [mid_combination[0]] + [item[0] for item in right_combinations]
-    )
-    combined_frequencies = normalized_frequencies_left + [mid_combination[2]] + normalized_frequencies_right
-
-    # Filter out 'MID' for plotting
-    filtered_combinations = [comb for comb in combined_combinations if comb != "MID"]
-    filtered_frequencies = [freq for comb, freq in zip(combined_combinations, combined_frequencies) if comb != "MID"]
-
-    # Sort the final combinations and frequencies
-    sorted_results = sorted(zip(filtered_combinations, filtered_frequencies), key=lambda x: x[1])
-
-    # Extract sorted combinations and frequencies
+                records[data["id"]] = (line, data)
+    return records
+
+
+def read_dataset(path: str) -> Tuple[List[str], List[Dict]]:
+    # Raw lines and the id and annotation of every record, read in one pass. The raw lines, posts included, are kept
+    # until the output is written, but only as strings: they are parsed into records again one at a time while writing.
+    lines, records = [], []
+    with open(path) as f:
+        for line in f:
+            data = json.loads(line)
+            lines.append(line)
+            records.append({"id": data["id"], "annotation": data["annotation"]})
+    return lines, records
+
+
+def write_dataset(
+    output_path: str,
+    dataset: Iterable[Dict],
+    softlabels: np.ndarray,
+    hardlabels: np.ndarray,
+    existing: Optional[Dict[int, Tuple[str, Dict]]] = None,
+    intervals: Optional[Tuple[np.ndarray, np.ndarray]] = None,
+) -> int:
+    # Writes the labelled dataset atomically and returns the number of records written anew. Records of existing whose
+    # annotation and labels did not change are copied over as they are. intervals adds the bootstrap interval of every
+    # soft label, see get_softlabel_intervals.
+    existing = existing or {}
+    tmp_path = f"{output_path}.{os.getpid()}.tmp"
+    rewritten = 0
+    with open(tmp_path, "w") as f:
+        for u, data in enumerate(dataset):
+            labelled_data = {
+                **data,
+                "softlabels": {dim: float(softlabels[d, u]) for d, dim in enumerate(DIMS)},
+                "hardlabels": {dim: dim[0] if hardlabels[d, u] else dim[-1] for d, dim in enumerate(DIMS)},
+            }
+            if intervals is not None:
+                # null where no resample contains the combination, NaN is not valid JSON
+                labelled_data["softlabel_intervals"] = {
+                    dim: [None if np.isnan(bound[d, u]) else float(bound[d, u]) for bound in intervals]
+                    for d, dim in enumerate(DIMS)
+                }
+            line, existing_data = existing.get(data["id"], (None, None))
+            if existing_data is not None and all(
+                existing_data.get(key) == labelled_data.get(key)
+                for key in ["annotation", "softlabels", "hardlabels", "softlabel_intervals"]
+            ):
+                f.write(line)
+            else:
+                f.write(json.dumps(labelled_data, ensure_ascii=False) + "\n")
+                rewritten += 1
+    os.replace(tmp_path, output_path)
+    return rewritten
+
+
+def plot_softlabels(softlabels: Dict[str, float], output_path: str):
+    # Bar chart of P(first letter) per combination, as in the paper. matplotlib is only imported here, so building the
+    # labels runs without it.
+    import matplotlib.pyplot as plt
+
+    sorted_results = sorted(((combination, 1 - value) for combination, value in softlabels.items()), key=lambda x: x[1])
     sorted_combinations, sorted_frequencies = zip(*sorted_results) if sorted_results else ([], [])
 
-    # Plot the final bar chart
     plt.figure(figsize=(12, 8))
-    bars = plt.bar(sorted_combinations, sorted_frequencies, color="skyblue")
+    plt.bar(sorted_combinations, sorted_frequencies, color="skyblue")
     plt.axhline(y=0.5, color="r", linestyle="--", label="Result = 0.5")
     plt.xlabel("Combination", fontsize=20)
     plt.ylabel("Soft Label", fontsize=20)
     plt.xticks(rotation=90, fontsize=20)
     plt.yticks(fontsize=20)
     plt.tight_layout()
-
-    output_path = "./JP_F.png"
-    # plt.savefig(output_path)
-    # plt.show()
-
-    return sorted_combinations, sorted_frequencies
+    plt.savefig(output_path)
+    plt.close()
+
+
+@dataclass
+class Arguments:
+    command: str
+    input: str
+    output: str
+    state: str
+    incremental: bool
+    converge: bool
+    bootstrap: int
+    confidence: float
+    seed: int
+    plot_dir: str
+
+
+def build(args: Arguments):
+    lines, records = read_dataset(args.input)
+    annotations = encode_annotations(records)
+    existing, init, fitted_users = {}, None, None
+    if args.incremental and os.path.exists(args.state):
+        # Users whose annotation is unchanged since the last fit do not need to move
+        existing = load_dataset(args.output)
+        init = load_state(args.state, annotations)
+        fitted_users = np.array(
+            [data["id"] in existing and existing[data["id"]][1]["annotation"] == data["annotation"] for data in records]
+        )
+    # The published tolerance stops where the start point still shows, so incremental fits always converge
+    converge = args.converge or args.incremental
+    log_likelihood_tolerance = 1e-10 if converge else None
+    posteriors, matrix, PE = run_em(
+        annotations,
+        tolerance=1e-1,
+        max_iterations=10000,
+        log_likelihood_tolerance=log_likelihood_tolerance,
+        squarem=converge,
+        init=init,
+        fitted_users=fitted_users,
+    )
+    softlabels = get_softlabels(annotations, posteriors)
+    hardlabels = get_hardlabels(annotations, softlabels)
+    intervals = None
+    if args.bootstrap > 0:
+        bootstrap_posteriors, weights = run_bootstrap_em(annotations, args.bootstrap, args.seed)
+        intervals = get_softlabel_intervals(annotations, bootstrap_posteriors, weights, args.confidence)
+
+    # Saved on every run, also when the output is kept, so the next --incremental run warm-starts from it
+    save_state(args.state, annotations, matrix, PE)
+    # A plain build keeps an existing dataset, as the published soft labels were computed from scratch
+    if args.incremental or args.converge or args.bootstrap > 0 or not os.path.exists(args.output):
+        dataset = (json.loads(line) for line in lines)
+        rewritten = write_dataset(args.output, dataset, softlabels, hardlabels, existing, intervals)
+        print(f"{rewritten} of {len(records)} records written to {args.output}")
+    else:
+        print(f"{args.output} exists and is kept, use --incremental or --converge to update it")
+
+
+def plot(args: Arguments):
+    # Plots the soft labels of the labelled dataset, one chart per dimension, without fitting EM again
+    records, softlabels = [], []
+    with open(args.output) as f:
+        for line in f:
+            data = json.loads(line)
+            records.append({"annotation": data["annotation"]})
+            softlabels.append([data["softlabels"][dim] for dim in DIMS])
+    softlabels = np.array(softlabels).T
+    os.makedirs(args.plot_dir, exist_ok=True)
+    for d, dim in enumerate(DIMS):
+        output_path = os.path.join(args.plot_dir, f"{dim[0]}{dim[-1]}_F.png")
+        plot_softlabels(get_combination_softlabels(records, softlabels, d), output_path)
+        print(f"Saved {output_path}")
 
 
 if __name__ == "__main__":
-    file_path = "dataset/mbtibench-nolabel.jsonl"
-
-    sorted_combinationsei, sorted_frequenciesei = processei([file_path], tolerance=1e-1, max_iterations=10000)
-    sorted_combinationssn, sorted_frequenciessn = processsn([file_path], tolerance=1e-1, max_iterations=10000)
-    sorted_combinationstf, sorted_frequenciestf = processtf([file_path], tolerance=1e-1, max_iterations=10000)
-    sorted_combinationsjp, sorted_frequenciesjp = processjp([file_path], tolerance=1e-1, max_iterations=10000)
-
-    results_dict = {
-        "E/I": dict(zip(sorted_combinationsei, sorted_frequenciesei)),
-        "S/N": dict(zip(sorted_combinationssn, sorted_frequenciessn)),
-        "T/F": dict(zip(sorted_combinationstf, sorted_frequenciestf)),
-        "J/P": dict(zip(sorted_combinationsjp, sorted_frequenciesjp)),
-    }
-
-    with open(file_path) as f:
-        dataset_nolabel = [json.loads(line.strip()) for line in f]
-
-    dims = ["E/I", "S/N", "T/F", "J/P"]
-    dataset_with_softlabel = []
-    for data in dataset_nolabel:
-        softlabels, hardlabels = {}, {}
-        for dim in dims:
-            annotation = "".join(data["annotation"][dim].values())
-            softlabel = 1 - results_dict[dim][annotation]
-            hardlabel = dim[0] if annotation.count(dim[0]) >= 2 else dim[-1]
-            softlabels[dim] = softlabel
-            hardlabels[dim] = hardlabel
-        dataset_with_softlabel.append({**data, "softlabels": softlabels, "hardlabels": hardlabels})
-
-    if not os.path.exists("dataset/mbtibench.jsonl"):
-        with open("dataset/mbtibench.jsonl", "w") as f:
-            for data in dataset_with_softlabel:
-                f.write(json.dumps(data, ensure_ascii=False) + "\n")
+    parser = argparse.ArgumentParser(description="MbtiBench Soft Labels")
+    subparsers = parser.add_subparsers(dest="command")
+    build_parser = subparsers.add_parser("build", help="Fit EM on --input and write --output, the default command")
+    build_parser.add_argument("--input", type=str, help="Annotated dataset", default="dataset/mbtibench-nolabel.jsonl")
+    build_parser.add_argument("--output", type=str, help="Labelled dataset", default="dataset/mbtibench.jsonl")
+    build_parser.add_argument("--state", type=str, help="Fitted EM state", default="dataset/em_state.npz")
+    build_parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Warm-start from --state and update --output in place, rewriting only records whose labels changed",
+    )
+    build_parser.add_argument(
+        "--converge",
+        action="store_true",
+        help="Fit with SQUAREM to a relative log-likelihood change of 1e-10 instead of the published tolerance, "
+        "implied by --incremental. Writes --output even if it exists",
+    )
+    build_parser.add_argument(
+        "--bootstrap", type=int, help="Bootstrap resamples for soft label intervals, 0 for none", default=0
+    )
+    build_parser.add_argument("--confidence", type=float, help="Confidence level of soft label intervals", default=0.95)
+    build_parser.add_argument("--seed", type=int, help="Seed of bootstrap resamples", default=0)
+    plot_parser = subparsers.add_parser("plot", help="Plot the soft labels of --output per annotation combination")
+    plot_parser.add_argument("--output", type=str, help="Labelled dataset", default="dataset/mbtibench.jsonl")
+    plot_parser.add_argument("--plot_dir", type=str, help="Directory of the charts", default=".")
+
+    # Without a command the labels are built, as before there were commands
+    argv = sys.argv[1:]
+    if not argv or argv[0] not in ["build", "plot", "-h", "--help"]:
+        argv = ["build", *argv]
+    args = cast(Arguments, parser.parse_args(argv))
+
+    if args.command == "plot":
+        plot(args)
+    else:
+        build(args)
@@ -1,10 +1,10 @@
 import logging
 import re
-import sqlite3
 from typing import List
 
 import numpy as np
 
+from mbtibench.database import connect_readonly
 from mbtibench.enums import MetricName
 from mbtibench.evaluator import Evaluator, Metric
 
@@ -13,15 +13,15 @@ logger = logging.getLogger(__name__)
 
 class DreadditEvaluator(Evaluator):
     @property
-    def _validate_database_sql(self) -> str:
-        return "SELECT id, response FROM dreaddit"
+    def _load_database_sql(self) -> str:
+        return "SELECT id, response, label FROM dreaddit ORDER BY id"
 
-    def _validate(self):
+    def _load(self):
         assert self._database_path.exists(), f"Database not found: {self._database_path}"
 
-        conn = sqlite3.connect(self._database_path)
+        conn = connect_readonly(self._database_path)
         c = conn.cursor()
-        c.execute(self._validate_database_sql)
+        c.execute(self._load_database_sql)
         db_data = c.fetchall()
         conn.close()
         assert len(db_data) == 300  # Dreaddit dataset size
@@ -29,25 +29,16 @@ class DreadditEvaluator(Evaluator):
         for row in db_data:
             assert "OPENAI API ERROR" not in row[1]
 
-    def _get_true_labels(self) -> np.ndarray:
-        conn = sqlite3.connect(self._database_path)
-        c = conn.cursor()
-        c.execute("SELECT label FROM dreaddit")
-        db_data = c.fetchall()
-        conn.close()
+        self._responses = [row[1] for row in db_data]
+        self._labels = [row[2] for row in db_data]
 
-        return np.array([0 if label[0] == "yes" else 1 for label in db_data])
+    def _get_true_labels(self) -> np.ndarray:
+        return np.array([0 if label == "yes" else 1 for label in self._labels])
 
     def _get_pred_labels(self) -> np.ndarray:
-        conn = sqlite3.connect(self._database_path)
-        c = conn.cursor()
-        c.execute("SELECT response FROM dreaddit")
-        db_data = c.fetchall()
-        conn.close()
-
         answers = []
-        for response in db_data:
-            response_clean = re.split(" |\n", response[0].strip())
+        for response in self._responses:
+            response_clean = re.split(" |\n", response.strip())
             response_clean = [
                 word.replace(".", "")
                 .replace(",", "")
@@ -1,10 +1,10 @@
-import sqlite3
 from pathlib import Path
-from typing import Any, Dict, Optional
+from typing import Any, Dict, List, Optional, Tuple
 
 from typing_extensions import assert_never
 
 from downstream.Dreaddit.prompt import DreadditDownstream, DreadditZeroShotSoft
+from mbtibench.database import connect_readonly, get_columns
 from mbtibench.enums import LabelType, MbtiDimension
 from mbtibench.evaluator import Exacter
 from mbtibench.executer import Executer
@@ -15,31 +15,32 @@ class DreadditMbtiExecuter(Executer):
     @property
     def _init_database_sql(self) -> str:
         return (
-            f"CREATE TABLE IF NOT EXISTS {self._dim.only_letter} "
-            f"(id INTEGER PRIMARY KEY, messages TEXT, response TEXT, posts TEXT, label TEXT, labeltype TEXT)"
+            f"CREATE TABLE IF NOT EXISTS {self._table_name} "
+            f"(id INTEGER PRIMARY KEY, messages TEXT, response TEXT, posts TEXT, label TEXT, labeltype TEXT, "
+            f"status TEXT, failures TEXT, softscore REAL, hardchoice TEXT, parsestatus TEXT)"
         )
 
     @property
     def _update_database_sql(self) -> str:
         return (
-            f"INSERT OR REPLACE INTO {self._dim.only_letter} "
-            f"(id, messages, response, posts, label, labeltype) "
+            f"INSERT OR REPLACE INTO {self._table_name} "
+            f"(id, messages, response, posts, label, labeltype, status, failures, softscore, hardchoice, parsestatus) "
             f"VALUES "
-            f"(:id, :messages, :response, :posts, :label, :labeltype)"
+            f"(:id, :messages, :response, :posts, :label, :labeltype, :status, :failures, "
+            f":softscore, :hardchoice, :parsestatus)"
         )
 
-    async def _single_run(self, llm: LLM, data: Dict, method_cls: Any) -> Dict:
+    def _build_prompts(self, llm: LLM, data: Dict, method_cls: Any) -> List[Dict[str, str]]:
         prompt_method: DreadditZeroShotSoft = method_cls(self._dim, data["posts"])
-        prompts = prompt_method.prompts
-
-        messages = llm.chat(prompts)
+        return prompt_method.prompts
 
+    def _build_result(self, llm: LLM, data: Dict, messages: List[Dict[str, str]]) -> Dict:
         assert messages[-1]["role"] == "assistant"
         response = messages[-1]["content"]
 
         return {
             "id": data["id"],
-            "messages": llm.show_real_prompt(messages),
+            "messages": llm.dump_messages(messages),
             "response": response,
             "posts": data["posts"],
             "label": data["label"],
@@ -64,50 +65,85 @@ class DreadditDownstreamExecuter(Executer):
             unformatted_mbti_answer = self._load_raw_mbti_answer(mbti_result_database_path)
             self._mbti_answer = self._format_mbti_answer(unformatted_mbti_answer)
 
+    @property
+    def _max_tokens(self) -> int:
+        return 8192
+
+    @property
+    def _flow(self) -> str:
+        return f"downstream--{self._type}"
+
+    @property
+    def _table_name(self) -> str:
+        return "dreaddit"
+
+    @property
+    def _migrations_sql(self) -> List[List[str]]:
+        # Stress answers are parsed by DreadditEvaluator, the table has no parsed prediction columns
+        migrations = super()._migrations_sql
+        migrations[2] = []
+        return migrations
+
     @property
     def _init_database_sql(self) -> str:
         return (
             "CREATE TABLE IF NOT EXISTS dreaddit "
-            "(id INTEGER PRIMARY KEY, messages TEXT, response TEXT, posts TEXT, label TEXT, labeltype TEXT)"
+            "(id INTEGER PRIMARY KEY, messages TEXT, response TEXT, posts TEXT, label TEXT, labeltype TEXT, "
+            "status TEXT, failures TEXT)"
         )
 
-    @property
-    def _load_database_sql(self) -> str:
-        return "SELECT id, messages FROM dreaddit"
-
     @property
     def _update_database_sql(self) -> str:
         return (
             "INSERT OR REPLACE INTO dreaddit "
-            "(id, messages, response, posts, label, labeltype) "
+            "(id, messages, response, posts, label, labeltype, status, failures) "
             "VALUES "
-            "(:id, :messages, :response, :posts, :label, :labeltype)"
+            "(:id, :messages, :response, :posts, :label, :labeltype, :status, :failures)"
         )
 
-    def _load_raw_mbti_answer(self, mbti_result_database_path: Path) -> Dict[int, Dict[MbtiDimension, str]]:
-        conn = sqlite3.connect(mbti_result_database_path)
+    def _load_raw_mbti_answer(
+        self, mbti_result_database_path: Path
+    ) -> Dict[int, Dict[MbtiDimension, Tuple[str, Optional[Dict]]]]:
+        # Response of every dimension, with the prediction parsed at write time if it was parsed for this label type
+        conn = connect_readonly(mbti_result_database_path)
         c = conn.cursor()
         all_data = {}
         for dim in MbtiDimension:
-            c.execute(f"SELECT id, response FROM {dim.only_letter}")
+            if "parsestatus" in get_columns(conn, dim.only_letter):
+                c.execute(f"SELECT id, response, labeltype, softscore, hardchoice, parsestatus FROM {dim.only_letter}")
+            else:
+                c.execute(f"SELECT id, response, labeltype, NULL, NULL, NULL FROM {dim.only_letter}")
             db_data = c.fetchall()
-            for data_id, response in db_data:
+            for data_id, response, labeltype, softscore, hardchoice, parsestatus in db_data:
                 if data_id not in all_data.keys():
                     all_data[data_id] = {}
-                all_data[data_id][dim] = response
+                prediction = None
+                if parsestatus is not None and labeltype == self._type.value:
+                    prediction = {"softscore": softscore, "hardchoice": hardchoice}
+                all_data[data_id][dim] = (response, prediction)
         conn.close()
         return all_data
 
-    def _format_mbti_answer(self, mbti_answer: Dict[int, Dict[MbtiDimension, str]]) -> Dict[int, str]:
+    def _format_mbti_answer(
+        self, mbti_answer: Dict[int, Dict[MbtiDimension, Tuple[str, Optional[Dict]]]]
+    ) -> Dict[int, str]:
         formatted_mbti_answer = {}
         for data_id, answer in mbti_answer.items():
             formatted_dim = ""
             for dim in MbtiDimension:
+                response, prediction = answer[dim]
                 if self._type == LabelType.SOFT:
-                    score = Exacter().get_softlabel(answer[dim])
+                    if prediction is not None:
+                        score = prediction["softscore"]
+                    else:
+                        score = Exacter().get_softlabel(response)
                     score = (score if score is not None else 0.5) * 100
                 elif self._type == LabelType.HARD:
-                    score = Exacter().get_hardlabel_as_softlabel(dim, answer[dim])
+                    if prediction is not None:
+                        hardchoice = prediction["hardchoice"]
+                        score = None if hardchoice is None else 1.0 if hardchoice == dim.first_letter else 0.0
+                    else:
+                        score = Exacter().get_hardlabel_as_softlabel(dim, response)
                     score = (score if score is not None else 0.5) * 100
                 else:
                     assert_never()
@@ -116,20 +152,22 @@ class DreadditDownstreamExecuter(Executer):
             formatted_mbti_answer[data_id] = formatted_dim
         return formatted_mbti_answer
 
-    async def _single_run(self, llm: LLM, data: Dict, method_cls: Any) -> Dict:
+    def _parse_response(self, response: str) -> Dict:
+        return {}
+
+    def _build_prompts(self, llm: LLM, data: Dict, method_cls: Any) -> List[Dict[str, str]]:
         prompt_method: DreadditDownstream = method_cls(
             data["posts"], self._mbti_answer[data["id"]] if self._type is not None else None, self._type
         )
-        prompts = prompt_method.prompts
-
-        messages = llm.chat(prompts, max_tokens=8192)
+        return prompt_method.prompts
 
+    def _build_result(self, llm: LLM, data: Dict, messages: List[Dict[str, str]]) -> Dict:
         assert messages[-1]["role"] == "assistant"
         response = messages[-1]["content"]
 
         return {
             "id": data["id"],
-            "messages": llm.show_real_prompt(messages),
+            "messages": llm.dump_messages(messages),
             "response": response,
             "posts": data["posts"],
             "label": data["label"],
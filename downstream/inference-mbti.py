@@ -7,6 +7,7 @@ from typing import Optional, cast
 from Dreaddit.executer import DreadditMbtiExecuter
 from Dreaddit.prompt import get_prompt_method_cls as dreaddit_get_prompt_method_cls
 
+from mbtibench.database import close_database_writers
 from mbtibench.enums import LabelType, MbtiDimension, ModelName, PromptMethodName
 from mbtibench.llm import LLM
 from mbtibench.utils import get_base_url_and_api_key
@@ -41,6 +42,7 @@ async def mbti(args: Arguments):
         tasks.append(executer.run(llm, method_cls))
 
     await asyncio.gather(*tasks)
+    await close_database_writers()
 
 
 if __name__ == "__main__":
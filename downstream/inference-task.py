@@ -9,6 +9,7 @@ import numpy as np
 from Dreaddit.executer import DreadditDownstreamExecuter
 from Dreaddit.prompt import DreadditDownstream
 
+from mbtibench.database import close_database_writers, connect_readonly, get_columns
 from mbtibench.enums import LabelType, MbtiDimension, ModelName, PromptMethodName
 from mbtibench.evaluator import Exacter
 from mbtibench.llm import LLM
@@ -27,15 +28,18 @@ class Arguments:
 
 
 def get_y_pred_to_y_true_map(database_path: Path, dim: MbtiDimension) -> Dict[float, float]:
-    conn = sqlite3.connect(database_path)
+    conn = connect_readonly(database_path)
     c = conn.cursor()
-    c.execute(f"SELECT response, softlabel FROM {dim.only_letter}")
+    if "parsestatus" in get_columns(conn, dim.only_letter):
+        c.execute(f"SELECT response, softlabel, softscore, parsestatus FROM {dim.only_letter}")
+    else:
+        c.execute(f"SELECT response, softlabel, NULL, NULL FROM {dim.only_letter}")
     db_data = c.fetchall()
     conn.close()
 
     y_pred_to_y_true = {}
-    for response, softlabel in db_data:
-        score = Exacter.get_softlabel(response)
+    for response, softlabel, softscore, parsestatus in db_data:
+        score = softscore if parsestatus is not None else Exacter.get_softlabel(response)
         score = (0.5 if score is None else score) * 8 + 1
         if score not in y_pred_to_y_true:
             y_pred_to_y_true[score] = []
@@ -163,6 +167,7 @@ async def downstream(args: Arguments):
     executer = executer_cls(dataset_path, database_path, mbti_result_database_path, None, args.type)
 
     await executer.run(llm, method_cls)
+    await close_database_writers()
 
 
 if __name__ == "__main__":
@@ -1,62 +1,228 @@
 import argparse
+import csv
+import json
+import logging
+from concurrent.futures import ProcessPoolExecutor
 from dataclasses import dataclass
+from itertools import product
 from pathlib import Path
-from typing import Dict, List, Tuple, cast
+from typing import Dict, List, Optional, Tuple, cast
 
 import numpy as np
 from typing_extensions import assert_never
 
 from mbtibench.enums import LabelType, MbtiDimension, MetricName, ModelName, PromptMethodName
-from mbtibench.evaluator import Evaluator
+from mbtibench.evaluator import Evaluator, Metric, eval_dimensions, eval_dimensions_bootstrap
+
+logger = logging.getLogger(__name__)
 
 
 @dataclass
 class Arguments:
-    model: ModelName
-    method: PromptMethodName
-    type: LabelType
+    model: Optional[ModelName]
+    method: Optional[PromptMethodName]
+    type: Optional[LabelType]
+    grid: bool
+    models: List[ModelName]
+    methods: List[PromptMethodName]
+    types: List[LabelType]
+    results_dir: Path
+    warehouse_dir: Optional[Path]
+    bootstrap: int
+    confidence: float
+    seed: int
+    workers: Optional[int]
+    output: Optional[Path]
+
+
+def get_rounds(model: ModelName) -> List[int]:
+    return [1] if model.is_gpt4 else list(range(1, 5 + 1))  # GPT-4 only has 1 round
+
+
+def get_metrics(type: LabelType) -> List[MetricName]:
+    if type == LabelType.SOFT:
+        return [MetricName.S_RMSE, MetricName.S_MAE]
+        # return [MetricName.RMSE, MetricName.MAE]
+    elif type == LabelType.HARD:
+        return [MetricName.ACC, MetricName.F1]
+    else:
+        assert_never()
+
+
+def evaluate_round(
+    results_dir: Path,
+    warehouse_dir: Optional[Path],
+    type: LabelType,
+    model: ModelName,
+    method: PromptMethodName,
+    round: int,
+    bootstrap: int = 0,
+    seed: int = 0,
+) -> Tuple[Dict[MbtiDimension, List[float]], Optional[Dict[MbtiDimension, List[np.ndarray]]]]:
+    # Metrics of every dimension, and their bootstrap distributions if bootstrap resamples are requested
+    if warehouse_dir is not None:
+        # pyarrow is only imported when reading from the warehouse
+        from mbtibench.warehouse import Warehouse, WarehouseEvaluator
+
+        warehouse = Warehouse(warehouse_dir)
+        evaluators = {dim: WarehouseEvaluator(warehouse, model, method, type, round, dim) for dim in MbtiDimension}
+    else:
+        database_path = results_dir / f"round-{round}" / f"{type}--{model}--{method}.db"
+        evaluators = {dim: Evaluator(database_path, dim) for dim in MbtiDimension}
+    scores = eval_dimensions(evaluators, type, get_metrics(type))
+    if bootstrap == 0:
+        return scores, None
+    return scores, eval_dimensions_bootstrap(evaluators, type, get_metrics(type), bootstrap, seed)
+
+
+def summarize(results: List[Dict[MbtiDimension, List[float]]]) -> Dict[MbtiDimension, List[Tuple[float, float]]]:
+    # (mean, std) over rounds of every metric
+    return {
+        dim: [
+            (np.mean([res[dim][i] for res in results]), np.std([res[dim][i] for res in results]))
+            for i in range(len(results[0][dim]))
+        ]
+        for dim in MbtiDimension
+    }
+
+
+def summarize_bootstrap(
+    resampled: List[Dict[MbtiDimension, List[np.ndarray]]], confidence: float
+) -> Dict[MbtiDimension, List[Tuple[float, float]]]:
+    # Confidence interval of the mean over rounds: rounds share their resamples, so they are averaged per resample
+    return {
+        dim: [
+            Metric.get_confidence_interval(np.mean([res[dim][i] for res in resampled], axis=0), confidence)
+            for i in range(len(resampled[0][dim]))
+        ]
+        for dim in MbtiDimension
+    }
+
+
+def format_summary(
+    summary: Dict[MbtiDimension, List[Tuple[float, float]]],
+    intervals: Optional[Dict[MbtiDimension, List[Tuple[float, float]]]] = None,
+) -> str:
+    formatted = ""
+    for dim, metrics in summary.items():
+        for i, (avg, std) in enumerate(metrics):
+            formatted += f"{avg:.2f}±{std:.2f}"
+            if intervals is not None:
+                low, high = intervals[dim][i]
+                formatted += f"[{low:.2f}~{high:.2f}]"
+            formatted += ","
+    return formatted
 
 
 def main(args: Arguments):
-    results: Dict[MbtiDimension, List[Tuple[float, float]]] = {dim: [] for dim in MbtiDimension}
-
-    for round in range(1, 5 + 1):
-        if args.model.is_gpt4 and round > 1:
-            break  # GPT-4 only has 1 round
-        for dim in MbtiDimension:
-            database_path = Path("results-reproduce") / f"round-{round}" / f"{args.type}--{args.model}--{args.method}.db"
-            evalutor = Evaluator(database_path, dim)
-            if args.type == LabelType.SOFT:
-                s_rmse, s_mae = evalutor.eval(args.type, [MetricName.S_RMSE, MetricName.S_MAE])
-                # s_rmse, s_mae = evalutor.eval([MetricName.RMSE, MetricName.MAE])
-                results[dim].append((s_rmse, s_mae))
-            elif args.type == LabelType.HARD:
-                acc, f1 = evalutor.eval(args.type, [MetricName.ACC, MetricName.F1])
-                results[dim].append((acc, f1))
-            else:
-                assert_never()
-
-    avg_results = {
-        dim: (
-            np.mean([r[0] for r in res]),
-            np.std([r[0] for r in res]),
-            np.mean([r[1] for r in res]),
-            np.std([r[1] for r in res]),
+    results = [
+        evaluate_round(
+            args.results_dir, args.warehouse_dir, args.type, args.model, args.method, round, args.bootstrap, args.seed
         )
-        for dim, res in results.items()
-    }
+        for round in get_rounds(args.model)
+    ]
+
+    intervals = None
+    if args.bootstrap > 0:
+        intervals = summarize_bootstrap([resampled for _, resampled in results], args.confidence)
+    print(format_summary(summarize([scores for scores, _ in results]), intervals))
+
+
+def _evaluate_grid_round(
+    results_dir: Path,
+    warehouse_dir: Optional[Path],
+    type: LabelType,
+    model: ModelName,
+    method: PromptMethodName,
+    round: int,
+    bootstrap: int,
+    seed: int,
+) -> Tuple[Optional[Tuple], Optional[str]]:
+    # Runs in a worker process, a database failing validation is reported instead of aborting the grid.
+    # Resamples are drawn in the worker from the seed, which keeps them paired without shipping the indices.
+    try:
+        return evaluate_round(results_dir, warehouse_dir, type, model, method, round, bootstrap, seed), None
+    except AssertionError as e:
+        return None, str(e)
+
+
+def grid(args: Arguments):
+    configs = list(product(args.types, args.models, args.methods))
+    keys = [(type, model, method, round) for type, model, method in configs for round in get_rounds(model)]
+
+    # Every round is one task, so the rounds of one configuration are evaluated in parallel as well
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        futures = {
+            key: executor.submit(
+                _evaluate_grid_round, args.results_dir, args.warehouse_dir, *key, args.bootstrap, args.seed
+            )
+            for key in keys
+        }
+        results = {key: future.result() for key, future in futures.items()}
+
+    rows = []
+    for type, model, method in configs:
+        rounds = get_rounds(model)
+        errors = [results[(type, model, method, round)][1] for round in rounds]
+        if any(error is not None for error in errors):
+            logger.warning(f"Skipping {type}--{model}--{method}: {next(error for error in errors if error)}")
+            continue
+
+        round_results = [results[(type, model, method, round)][0] for round in rounds]
+        summary = summarize([scores for scores, _ in round_results])
+        intervals = None
+        if args.bootstrap > 0:
+            intervals = summarize_bootstrap([resampled for _, resampled in round_results], args.confidence)
+
+        row = {"type": str(type), "model": str(model), "method": str(method), "rounds": len(rounds)}
+        for dim, metrics in summary.items():
+            for i, (metric, (avg, std)) in enumerate(zip(get_metrics(type), metrics)):
+                row[f"{dim}_{metric}_mean"] = float(avg)
+                row[f"{dim}_{metric}_std"] = float(std)
+                if intervals is not None:
+                    row[f"{dim}_{metric}_ci_low"], row[f"{dim}_{metric}_ci_high"] = intervals[dim][i]
+        rows.append(row)
+        print(f"{type},{model},{method},{format_summary(summary, intervals)}")
 
-    for dim, (avg_rmse, std_rmse, avg_mae, std_mae) in avg_results.items():
-        # print(f"{avg_rmse:.2f},{avg_mae:.2f}", end=",")
-        print(f"{avg_rmse:.2f}±{std_rmse:.2f},{avg_mae:.2f}±{std_mae:.2f}", end=",")
-    print()
+    if args.output is not None:
+        args.output.parent.mkdir(parents=True, exist_ok=True)
+        if args.output.suffix == ".json":
+            with open(args.output, "w") as f:
+                json.dump(rows, f, ensure_ascii=False, indent=2)
+        else:
+            fieldnames = list(dict.fromkeys(key for row in rows for key in row))
+            with open(args.output, "w", newline="") as f:
+                writer = csv.DictWriter(f, fieldnames=fieldnames)
+                writer.writeheader()
+                writer.writerows(rows)
+        print(f"Saved {len(rows)} rows to {args.output}")
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="MbtiBench Evaluate")
-    parser.add_argument("--model", type=ModelName, help="Model name", required=True)
-    parser.add_argument("--method", type=PromptMethodName, help="Prompt method name", required=True)
-    parser.add_argument("--type", type=LabelType, help="Soft or hard label", required=True)
+    parser.add_argument("--model", type=ModelName, help="Model name")
+    parser.add_argument("--method", type=PromptMethodName, help="Prompt method name")
+    parser.add_argument("--type", type=LabelType, help="Soft or hard label")
+    parser.add_argument("--grid", action="store_true", help="Evaluate every combination of models, methods and types")
+    parser.add_argument("--models", type=ModelName, nargs="+", help="Models of the grid", default=list(ModelName))
+    parser.add_argument(
+        "--methods", type=PromptMethodName, nargs="+", help="Prompt methods of the grid", default=list(PromptMethodName)
+    )
+    parser.add_argument("--types", type=LabelType, nargs="+", help="Label types of the grid", default=[LabelType.SOFT])
+    parser.add_argument("--results_dir", type=Path, help="Results directory", default=Path("results-reproduce"))
+    parser.add_argument("--warehouse_dir", type=Path, help="Read results from this warehouse, see ingest.py")
+    parser.add_argument(
+        "--bootstrap", type=int, help="Bootstrap resamples for confidence intervals, 0 for none", default=0
+    )
+    parser.add_argument("--confidence", type=float, help="Confidence level of bootstrap intervals", default=0.95)
+    parser.add_argument("--seed", type=int, help="Seed of bootstrap resamples, shared by all models", default=0)
+    parser.add_argument("--workers", type=int, help="Worker processes of the grid, defaults to the CPU count")
+    parser.add_argument("--output", type=Path, help="Grid table, JSON if the suffix is .json, CSV otherwise")
     args = cast(Arguments, parser.parse_args())
 
-    main(args)
+    if args.grid:
+        grid(args)
+    else:
+        if args.model is None or args.method is None or args.type is None:
+            parser.error("--model, --method and --type are required without --grid")
+        main(args)
@@ -1,14 +1,20 @@
 import argparse
 import asyncio
+import logging
 from dataclasses import dataclass
 from pathlib import Path
-from typing import Optional, cast
+from typing import List, Optional, cast
 
-from mbtibench.enums import LabelType, MbtiDimension, ModelName, PromptMethodName
+from mbtibench.database import close_database_writers
+from mbtibench.enums import CacheMode, LabelType, MbtiDimension, ModelName, PromptMethodName
 from mbtibench.executer import Executer
-from mbtibench.llm import LLM
+from mbtibench.llm import LLM, ResponseCache
 from mbtibench.prompt import get_prompt_method_cls
-from mbtibench.utils import get_base_url_and_api_key
+from mbtibench.retry import RetryPolicy
+from mbtibench.scheduler import AimdController, Scheduler
+from mbtibench.utils import gather_or_cancel, get_base_url_and_api_key
+
+logger = logging.getLogger(__name__)
 
 
 @dataclass
@@ -16,23 +22,80 @@ class Arguments:
     method: PromptMethodName
     model: ModelName
     type: LabelType
-    round: int
+    round: Optional[int]
+    rounds: Optional[List[int]]
     host: Optional[str]
     port: Optional[str]
+    max_concurrency: int
+    endpoint_concurrency: Optional[int]
+    adaptive: bool
+    min_concurrency: int
+    cache: CacheMode
+    cache_path: Path
+    cache_max_size: int
+    defer_prompt_rendering: bool
+    max_conversations: int
+    commit_every: int
+    commit_interval: float
+    max_attempts: int
+    retry_base_delay: float
+    retry_max_delay: float
+    failure_threshold: int
+    reset_timeout: float
+    max_probe_failures: int
+
+
+def parse_rounds(spec: str) -> List[int]:
+    # "1-5", "1,3,5" or "1-3,5", in the given order without duplicates
+    rounds = []
+    for part in spec.split(","):
+        first, _, last = part.partition("-")
+        rounds.extend(range(int(first), int(last or first) + 1))
+    if not rounds:
+        raise ValueError(f"No rounds in {spec}")
+    return list(dict.fromkeys(rounds))
 
 
 async def main(args: Arguments):
     base_url, api_key = get_base_url_and_api_key(args.host, args.port)
-    llm = LLM(args.model, base_url, api_key)
+    endpoint_concurrency = {base_url: args.endpoint_concurrency} if args.endpoint_concurrency is not None else None
+    controller = (
+        AimdController(
+            min(max(10, args.min_concurrency), args.max_concurrency), args.min_concurrency, args.max_concurrency
+        )
+        if args.adaptive
+        else None
+    )
+    scheduler = Scheduler(
+        args.max_concurrency,
+        endpoint_concurrency,
+        controller,
+        args.failure_threshold,
+        args.reset_timeout,
+        args.max_probe_failures,
+    )
+    cache = ResponseCache(args.cache_path, args.cache_max_size * 1024 * 1024, args.cache)
+    retry_policy = RetryPolicy(args.max_attempts, args.retry_base_delay, args.retry_max_delay)
+    llm = LLM(args.model, base_url, api_key, scheduler, cache, args.defer_prompt_rendering, retry_policy)
     method_cls = get_prompt_method_cls(args.method, args.type)
     dataset_path = Path("dataset") / "mbtibench.jsonl"
-    database_path = Path("results") / f"round-{args.round}" / f"{args.type}--{args.model}--{args.method}.db"
-    tasks = []
-    for dim in MbtiDimension:
-        executer = Executer(dataset_path, database_path, dim, args.type)
-        tasks.append(executer.run(llm, method_cls))
 
-    await asyncio.gather(*tasks)
+    # Rounds run one after another in this process, sharing the LLM client, scheduler, response cache, dataset and
+    # prepared posts, so only the first round pays for loading them. Each round still resumes from its own database.
+    try:
+        for round in args.rounds if args.rounds is not None else [args.round]:
+            logger.info(f"Running round {round}")
+            database_path = Path("results") / f"round-{round}" / f"{args.type}--{args.model}--{args.method}.db"
+            tasks = []
+            for dim in MbtiDimension:
+                executer = Executer(dataset_path, database_path, dim, args.type, round)
+                tasks.append(
+                    executer.run(llm, method_cls, args.max_conversations, args.commit_every, args.commit_interval)
+                )
+            await gather_or_cancel(*tasks)
+    finally:
+        await close_database_writers()
+        cache.close()
 
 
 if __name__ == "__main__":
@@ -40,9 +103,38 @@ if __name__ == "__main__":
     parser.add_argument("--method", type=PromptMethodName, help="Prompt method name", required=True)
     parser.add_argument("--model", type=ModelName, help="Model name", required=True)
     parser.add_argument("--type", type=LabelType, help="Soft or hard label", required=True)
-    parser.add_argument("--round", type=int, help="Experiment round", required=True)
+    round_group = parser.add_mutually_exclusive_group(required=True)
+    round_group.add_argument("--round", type=int, help="Experiment round")
+    round_group.add_argument("--rounds", type=parse_rounds, help="Experiment rounds run in one process, e.g. 1-5")
     parser.add_argument("--host", type=str, help="vLLM server host address", required=False)
     parser.add_argument("--port", type=str, help="vLLM server port number", required=False)
+    parser.add_argument("--max_concurrency", type=int, help="Max in-flight requests", required=False, default=40)
+    parser.add_argument("--endpoint_concurrency", type=int, help="Max in-flight requests per endpoint", required=False)
+    parser.add_argument("--adaptive", action="store_true", help="Adapt concurrency to latency and rate limits")
+    parser.add_argument("--min_concurrency", type=int, help="Lower bound of adaptive concurrency", default=1)
+    parser.add_argument("--cache", type=CacheMode, help="Response cache mode", default=CacheMode.READ_WRITE)
+    parser.add_argument("--cache_path", type=Path, help="Response cache file", default=Path("results") / "cache.db")
+    parser.add_argument("--cache_max_size", type=int, help="Response cache size bound in MB", default=1024)
+    parser.add_argument(
+        "--defer_prompt_rendering", action="store_true", help="Store messages as JSON instead of the rendered prompt"
+    )
+    parser.add_argument("--max_conversations", type=int, help="Max active conversations per dimension", default=64)
+    parser.add_argument("--commit_every", type=int, help="Commit results after this many rows", default=20)
+    parser.add_argument("--commit_interval", type=float, help="Commit results after this many seconds", default=5.0)
+    parser.add_argument("--max_attempts", type=int, help="Attempts per turn, including the first", default=6)
+    parser.add_argument(
+        "--retry_base_delay", type=float, help="Backoff delay of the first retry in seconds", default=1.0
+    )
+    parser.add_argument(
+        "--retry_max_delay", type=float, help="Upper bound of the backoff delay in seconds", default=60.0
+    )
+    parser.add_argument(
+        "--failure_threshold", type=int, help="Consecutive endpoint failures before pausing the endpoint", default=5
+    )
+    parser.add_argument("--reset_timeout", type=float, help="Seconds an endpoint stays paused at first", default=30.0)
+    parser.add_argument(
+        "--max_probe_failures", type=int, help="Failed probes of a paused endpoint before giving it up", default=5
+    )
     args = cast(Arguments, parser.parse_args())
 
     asyncio.run(main(args))
@@ -0,0 +1,27 @@
+import argparse
+from dataclasses import dataclass
+from pathlib import Path
+from typing import cast
+
+from mbtibench.warehouse import Warehouse
+
+
+@dataclass
+class Arguments:
+    results_dir: Path
+    warehouse_dir: Path
+
+
+def main(args: Arguments):
+    warehouse = Warehouse(args.warehouse_dir)
+    ingested = warehouse.ingest(args.results_dir)
+    print(f"Ingested {ingested} databases of {args.results_dir} into {args.warehouse_dir}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="MbtiBench Results Warehouse Ingest")
+    parser.add_argument("--results_dir", type=Path, help="Results directory", default=Path("results"))
+    parser.add_argument("--warehouse_dir", type=Path, help="Warehouse directory", default=Path("warehouse"))
+    args = cast(Arguments, parser.parse_args())
+
+    main(args)
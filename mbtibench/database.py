@@ -0,0 +1,86 @@
+import asyncio
+import logging
+import sqlite3
+from pathlib import Path
+from typing import Dict, List, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+_database_writers: Dict[Tuple[Path, asyncio.AbstractEventLoop], "DatabaseWriter"] = {}
+
+
+def connect_readonly(database_path: Path) -> sqlite3.Connection:
+    # Read-only connections never take the write lock, so they can read while a run is writing
+    return sqlite3.connect(f"{database_path.resolve().as_uri()}?mode=ro", uri=True)
+
+
+def get_columns(conn: sqlite3.Connection, table_name: str) -> Set[str]:
+    return {row[1] for row in conn.execute(f"PRAGMA table_info({table_name})")}
+
+
+class DatabaseWriter:
+    # Single writer of one database file: writes from all executers are queued, grouped into one transaction
+    # with executemany, and committed in a worker thread so fsync never blocks the event loop
+    def __init__(self, database_path: Path):
+        self._database_path = database_path
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._task: Optional[asyncio.Task] = None
+
+        self._conn = sqlite3.connect(database_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+
+    async def write(self, sql: str, rows: List[Dict]):
+        # Returns once the rows are committed
+        if self._task is None:
+            self._task = asyncio.create_task(self._consume())
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((sql, rows, future))
+        await future
+
+    async def _consume(self):
+        while True:
+            items = [await self._queue.get()]
+            while not self._queue.empty():
+                items.append(self._queue.get_nowait())
+            stop = any(item is None for item in items)  # Sentinel from close()
+            items = [item for item in items if item is not None]
+
+            if items:
+                writes = [(sql, rows) for sql, rows, _ in items]
+                try:
+                    await asyncio.to_thread(self._write, writes)
+                except Exception as e:
+                    for _, _, future in items:
+                        future.set_exception(e)
+                else:
+                    for _, _, future in items:
+                        future.set_result(None)
+            if stop:
+                return
+
+    def _write(self, writes: List[Tuple[str, List[Dict]]]):
+        with self._conn:
+            for sql, rows in writes:
+                self._conn.executemany(sql, rows)
+        logger.info(f"Committed {sum(len(rows) for _, rows in writes)} rows to {self._database_path}")
+
+    async def close(self):
+        # Queued writes are committed before the connection is closed
+        if self._task is not None:
+            await self._queue.put(None)
+            await self._task
+        self._conn.close()
+
+
+def get_database_writer(database_path: Path) -> DatabaseWriter:
+    key = (database_path.resolve(), asyncio.get_running_loop())
+    if key not in _database_writers:
+        _database_writers[key] = DatabaseWriter(database_path)
+    return _database_writers[key]
+
+
+async def close_database_writers():
+    loop = asyncio.get_running_loop()
+    for key in [key for key in _database_writers if key[1] is loop]:
+        await _database_writers.pop(key).close()
@@ -0,0 +1,92 @@
+import hashlib
+import json
+import logging
+import re
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Records are written with "id" as their first key, which lets the index skip parsing whole lines
+_LEADING_ID_PATTERN = re.compile(rb'^\s*\{\s*"id"\s*:\s*(-?\d+)\s*[,}]')
+
+_datasets: Dict[Path, "JsonlDataset"] = {}
+
+
+class JsonlDataset:
+    # Read-only view of a JSONL dataset: a byte-offset index by id, with records parsed lazily on access
+    def __init__(self, path: Path, cache_size: int = 1024):
+        self._path = path
+        self._cache_size = cache_size
+        self._cache: "OrderedDict[int, Dict]" = OrderedDict()
+        self._offsets = self._build_index()
+        self._digest: Optional[str] = None
+        self._file = open(path, "rb")
+
+        logger.info(f"Indexed {len(self._offsets)} records of {path}")
+
+    def _build_index(self) -> Dict[int, int]:
+        offsets, offset = {}, 0
+        with open(self._path, "rb") as f:
+            for line in f:
+                if line.strip():
+                    match = _LEADING_ID_PATTERN.match(line)
+                    data_id = int(match.group(1)) if match is not None else json.loads(line)["id"]
+                    assert data_id not in offsets, f"Duplicate id {data_id} in {self._path}"
+                    offsets[data_id] = offset
+                offset += len(line)
+        return offsets
+
+    @property
+    def path(self) -> Path:
+        return self._path
+
+    @property
+    def digest(self) -> str:
+        # SHA-256 of the file content, computed on first use
+        if self._digest is None:
+            digest = hashlib.sha256()
+            with open(self._path, "rb") as f:
+                for chunk in iter(lambda: f.read(1 << 20), b""):
+                    digest.update(chunk)
+            self._digest = digest.hexdigest()
+        return self._digest
+
+    @property
+    def ids(self) -> List[int]:
+        return list(self._offsets.keys())
+
+    def __len__(self) -> int:
+        return len(self._offsets)
+
+    def __contains__(self, data_id: int) -> bool:
+        return data_id in self._offsets
+
+    def __getitem__(self, data_id: int) -> Dict:
+        if data_id in self._cache:
+            self._cache.move_to_end(data_id)
+            return self._cache[data_id]
+
+        self._file.seek(self._offsets[data_id])
+        data = json.loads(self._file.readline())
+
+        self._cache[data_id] = data
+        if len(self._cache) > self._cache_size:
+            self._cache.popitem(last=False)
+        return data
+
+    def __iter__(self) -> Iterator[Dict]:
+        # Sequential scan in file order, bypassing the record cache
+        with open(self._path, "rb") as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def get_dataset(path: Path) -> JsonlDataset:
+    # One shared view per file and process, so executers of all dimensions share the index and record cache
+    path = path.resolve()
+    if path not in _datasets:
+        _datasets[path] = JsonlDataset(path)
+    return _datasets[path]
@@ -133,3 +133,53 @@ class LabelType(Enum):
 
     def __str__(self) -> str:
         return self.value
+
+
+class CacheMode(Enum):
+    READ_WRITE = "read-write"
+    READ_ONLY = "read-only"
+    BYPASS = "bypass"
+
+    def __str__(self) -> str:
+        return self.value
+
+
+class ResultStatus(Enum):
+    OK = "ok"
+    ERROR = "error"
+
+    def __str__(self) -> str:
+        return self.value
+
+
+class ErrorKind(Enum):
+    RATE_LIMIT = "rate-limit"
+    TIMEOUT = "timeout"
+    CONNECTION = "connection"
+    SERVER = "server"
+    CONTEXT_LENGTH = "context-length"
+    OTHER = "other"
+
+    def __str__(self) -> str:
+        return self.value
+
+    @property
+    def retryable(self) -> bool:
+        # Errors caused by the request itself fail the same way on every attempt
+        return self not in (ErrorKind.CONTEXT_LENGTH, ErrorKind.OTHER)
+
+    @property
+    def is_congestion(self) -> bool:
+        return self in (ErrorKind.RATE_LIMIT, ErrorKind.TIMEOUT)
+
+    @property
+    def is_endpoint_down(self) -> bool:
+        return self in (ErrorKind.CONNECTION, ErrorKind.SERVER)
+
+
+class ParseStatus(Enum):
+    OK = "ok"
+    BAD = "bad"
+
+    def __str__(self) -> str:
+        return self.value
@@ -1,17 +1,20 @@
 import logging
 import re
-import sqlite3
 from pathlib import Path
-from typing import List, Optional
+from typing import Any, Dict, List, Optional, Tuple
 
 import numpy as np
 from sklearn.metrics import accuracy_score, f1_score, mean_absolute_error, root_mean_squared_error
 from typing_extensions import assert_never
 
-from .enums import LabelType, MbtiDimension, MetricName
+from .database import connect_readonly, get_columns
+from .enums import LabelType, MbtiDimension, MetricName, ParseStatus
 
 logger = logging.getLogger(__name__)
 
+# Edges of the 9 equal-width buckets of [0, 1] used by S-MAE and S-RMSE
+BUCKET_EDGES = np.linspace(0, 1, 9 + 1)
+
 
 class Metric:
     @classmethod
@@ -73,6 +76,89 @@ class Metric:
     def _f1_score(cls, y_true: np.ndarray, y_pred: np.ndarray) -> float:
         return f1_score(y_true, y_pred, average="macro") * 100
 
+    @classmethod
+    def get_bootstrap_indices(cls, n: int, n_resamples: int = 2000, seed: int = 0) -> np.ndarray:
+        # (n_resamples, n) sample indices. The same n and seed give the same resamples, which keeps the bootstrap
+        # distributions of different models, methods and rounds paired.
+        return np.random.default_rng(seed).integers(0, n, size=(n_resamples, n))
+
+    @classmethod
+    def compute_batch(cls, name: MetricName, y_true: np.ndarray, y_pred: np.ndarray) -> np.ndarray:
+        # Metric along the last axis, e.g. a (dims, samples) matrix gives one score per dimension.
+        # Agrees with compute on every 1-D slice, without the per-call input validation of sklearn.
+        if name == MetricName.MAE:
+            return np.abs(y_true - y_pred).mean(axis=-1)
+        elif name == MetricName.RMSE:
+            return np.sqrt(np.square(y_true - y_pred).mean(axis=-1))
+        elif name == MetricName.S_MAE:
+            return np.abs(cls._bucketize(y_true) - cls._bucketize(y_pred)).mean(axis=-1)
+        elif name == MetricName.S_RMSE:
+            return np.sqrt(np.square(cls._bucketize(y_true) - cls._bucketize(y_pred)).mean(axis=-1))
+        elif name == MetricName.ACC:
+            return (y_true == y_pred).mean(axis=-1) * 100
+        elif name == MetricName.F1:
+            return cls._batch_f1_score(y_true, y_pred)
+        else:
+            assert_never()
+
+    @classmethod
+    def compute_all(cls, metrics: List[MetricName], y_true: np.ndarray, y_pred: np.ndarray) -> np.ndarray:
+        # (metrics, ...) scores of every metric, bucketized labels are shared by S-MAE and S-RMSE
+        if MetricName.S_MAE in metrics or MetricName.S_RMSE in metrics:
+            true_binned, pred_binned = cls._bucketize(y_true), cls._bucketize(y_pred)
+        scores = []
+        for name in metrics:
+            if name == MetricName.S_MAE:
+                scores.append(np.abs(true_binned - pred_binned).mean(axis=-1))
+            elif name == MetricName.S_RMSE:
+                scores.append(np.sqrt(np.square(true_binned - pred_binned).mean(axis=-1)))
+            else:
+                scores.append(cls.compute_batch(name, y_true, y_pred))
+        return np.stack(scores)
+
+    @classmethod
+    def compute_resampled(
+        cls, name: MetricName, y_true: np.ndarray, y_pred: np.ndarray, indices: np.ndarray
+    ) -> np.ndarray:
+        # Metric of every resample at once, agrees with compute on each row of indices.
+        # (dims, samples) labels give (dims, resamples) scores.
+        return cls.compute_batch(name, y_true[..., indices], y_pred[..., indices])
+
+    @classmethod
+    def _bucketize(cls, y: np.ndarray, bins: int = 9) -> np.ndarray:
+        # Same buckets as _bucket_mae_score and _bucket_rmse_score
+        edges = BUCKET_EDGES if bins == len(BUCKET_EDGES) - 1 else np.linspace(0, 1, bins + 1)
+        return np.digitize(y, edges) - 1
+
+    @classmethod
+    def _batch_f1_score(cls, y_true: np.ndarray, y_pred: np.ndarray) -> np.ndarray:
+        # Macro F1 over the labels present in each slice, like f1_score on every 1-D slice
+        labels, encoded = np.unique(
+            np.concatenate([y_true.astype(str), y_pred.astype(str)], axis=-1), return_inverse=True
+        )
+        encoded = encoded.reshape(*y_true.shape[:-1], -1)
+        true_codes, pred_codes = encoded[..., : y_true.shape[-1]], encoded[..., y_true.shape[-1] :]
+        f1_sum, present = np.zeros(y_true.shape[:-1]), np.zeros(y_true.shape[:-1])
+        for label in range(len(labels)):
+            is_true, is_pred = true_codes == label, pred_codes == label
+            tp = (is_true & is_pred).sum(axis=-1)
+            denominator = is_true.sum(axis=-1) + is_pred.sum(axis=-1)  # 2tp + fp + fn
+            f1_sum += np.divide(2 * tp, denominator, out=np.zeros(f1_sum.shape), where=denominator > 0)
+            present += denominator > 0
+        return f1_sum / present * 100
+
+    @classmethod
+    def get_confidence_interval(cls, resampled: np.ndarray, confidence: float = 0.95) -> Tuple[float, float]:
+        # Percentile interval of a bootstrap distribution
+        low, high = np.quantile(resampled, [(1 - confidence) / 2, (1 + confidence) / 2])
+        return float(low), float(high)
+
+    @classmethod
+    def get_paired_p_value(cls, resampled_a: np.ndarray, resampled_b: np.ndarray) -> float:
+        # Two-sided p-value of a metric difference, both distributions must come from the same indices
+        diff = resampled_a - resampled_b
+        return float(min(2 * min(np.mean(diff <= 0), np.mean(diff >= 0)), 1.0))
+
 
 class Exacter:
     @classmethod
@@ -107,26 +193,67 @@ class Exacter:
         else:
             return 1.0 if hardlabel == dim.first_letter else 0.0
 
+    @classmethod
+    def parse(cls, dim: MbtiDimension, type: LabelType, text: Optional[str]) -> Dict[str, Any]:
+        # Prediction of a result row, only the label type of the run is parsed. Rows of refusals may have no response.
+        text = text if text is not None else ""
+        if type == LabelType.SOFT:
+            softscore, hardchoice = cls.get_softlabel(text), None
+            parsed = softscore is not None
+        elif type == LabelType.HARD:
+            softscore, hardchoice = None, cls.get_hardlabel(dim, text)
+            parsed = hardchoice is not None
+        else:
+            assert_never()
+        return {
+            "softscore": softscore,
+            "hardchoice": hardchoice,
+            "parsestatus": (ParseStatus.OK if parsed else ParseStatus.BAD).value,
+        }
+
 
 class Evaluator:
     def __init__(self, database_path: Path, dim: MbtiDimension):
         self._database_path = database_path
         self._dim = dim
+        self._model_softlabels: Optional[np.ndarray] = None
+        self._model_hardlabels: Optional[np.ndarray] = None
 
-        self._validate()
+        self._load()
 
     @property
-    def _validate_database_sql(self) -> str:
-        return f"SELECT id, response FROM {self._dim.only_letter}"
-
-    def _validate(self):
-        assert self._database_path.exists(), f"Database not found: {self._database_path}"
+    def _load_database_sql(self) -> str:
+        return (
+            f"SELECT id, response, softlabel, hardlabel, labeltype, softscore, hardchoice, parsestatus "
+            f"FROM {self._dim.only_letter} ORDER BY id"
+        )
 
-        conn = sqlite3.connect(self._database_path)
+    @property
+    def _load_legacy_database_sql(self) -> str:
+        # Databases written before predictions were parsed at write time, see backfill.py
+        return (
+            f"SELECT id, response, softlabel, hardlabel, labeltype, NULL, NULL, NULL "
+            f"FROM {self._dim.only_letter} ORDER BY id"
+        )
+
+    def _fetch_rows(self) -> List[Tuple]:
+        # (id, response, softlabel, hardlabel, labeltype, softscore, hardchoice, parsestatus) ordered by id
+        conn = connect_readonly(self._database_path)
         c = conn.cursor()
-        c.execute(self._validate_database_sql)
+        if "parsestatus" in get_columns(conn, self._dim.only_letter):
+            c.execute(self._load_database_sql)
+        else:
+            logger.info(f"No parsed predictions in {self._database_path}, parsing responses")
+            c.execute(self._load_legacy_database_sql)
         db_data = c.fetchall()
         conn.close()
+        return db_data
+
+    def _load(self):
+        # Rows are read in one query and validated in the same pass, every metric is served from the cached arrays
+        assert self._database_path.exists(), f"Database not found: {self._database_path}"
+
+        db_data = self._fetch_rows()
         assert (
             len(db_data) == 286
         ), f"Database {self._database_path} len = {len(db_data)} != 286"  # MbtiBench dataset size
@@ -134,34 +261,41 @@ class Evaluator:
         for row in db_data:
             assert "OPENAI API ERROR" not in row[1]
 
-    def _get_human_softlables(self) -> np.ndarray:
-        conn = sqlite3.connect(self._database_path)
-        c = conn.cursor()
-        c.execute(f"SELECT softlabel FROM {self._dim.only_letter}")
-        db_data = c.fetchall()
-        conn.close()
+        self._ids = [row[0] for row in db_data]
+        self._responses = [row[1] for row in db_data]
+        self._human_softlabels = np.array([row[2] for row in db_data])
+        self._human_hardlabels = np.array([row[3] for row in db_data])
+        # (labeltype, softscore, hardchoice) of rows with a stored prediction, None for rows to parse
+        self._predictions: List[Optional[Tuple[str, Optional[float], Optional[str]]]] = [
+            (row[4], row[5], row[6]) if row[7] is not None else None for row in db_data
+        ]
 
-        return np.array([softlabel[0] for softlabel in db_data])
+    def _get_human_softlables(self) -> np.ndarray:
+        return self._human_softlabels
 
     def _get_human_hardlables(self) -> np.ndarray:
-        conn = sqlite3.connect(self._database_path)
-        c = conn.cursor()
-        c.execute(f"SELECT hardlabel FROM {self._dim.only_letter}")
-        db_data = c.fetchall()
-        conn.close()
-
-        return np.array([softlabel[0] for softlabel in db_data])
+        return self._human_hardlabels
 
-    def _get_softlabel_from_text(self, id: int, text: str) -> float:
-        score = Exacter.get_softlabel(text)
+    def _get_softlabel_from_text(
+        self, id: int, text: str, prediction: Optional[Tuple[str, Optional[float], Optional[str]]] = None
+    ) -> float:
+        if prediction is not None and prediction[0] == LabelType.SOFT.value:
+            score = prediction[1]
+        else:
+            score = Exacter.get_softlabel(text)
         if score is not None:
             return score
         else:
             logger.info(f"Data id={id}, bad response from model: {text}, using default 0.5 score")
             return 0.5
 
-    def _get_hardlabel_from_text(self, id: int, text: str) -> str:
-        label = Exacter.get_hardlabel(self._dim, text)
+    def _get_hardlabel_from_text(
+        self, id: int, text: str, prediction: Optional[Tuple[str, Optional[float], Optional[str]]] = None
+    ) -> str:
+        if prediction is not None and prediction[0] == LabelType.HARD.value:
+            label = prediction[2]
+        else:
+            label = Exacter.get_hardlabel(self._dim, text)
         if label is not None:
             return label
         else:
@@ -169,38 +303,68 @@ class Evaluator:
             return 1
 
     def _get_model_softlabels(self) -> np.ndarray:
-        conn = sqlite3.connect(self._database_path)
-        c = conn.cursor()
-        c.execute(f"SELECT id, response FROM {self._dim.only_letter}")
-        db_data = c.fetchall()
-        conn.close()
-
-        return np.array([self._get_softlabel_from_text(id, response) for id, response in db_data])
+        if self._model_softlabels is None:
+            self._model_softlabels = np.array(
+                [
+                    self._get_softlabel_from_text(id, response, prediction)
+                    for id, response, prediction in zip(self._ids, self._responses, self._predictions)
+                ]
+            )
+        return self._model_softlabels
 
     def _get_model_hardlabels(self) -> np.ndarray:
-        conn = sqlite3.connect(self._database_path)
-        c = conn.cursor()
-        c.execute(f"SELECT id, response FROM {self._dim.only_letter}")
-        db_data = c.fetchall()
-        conn.close()
-
-        return np.array([self._get_hardlabel_from_text(id, response) for id, response in db_data])
+        if self._model_hardlabels is None:
+            self._model_hardlabels = np.array(
+                [
+                    self._get_hardlabel_from_text(id, response, prediction)
+                    for id, response, prediction in zip(self._ids, self._responses, self._predictions)
+                ]
+            )
+        return self._model_hardlabels
 
     def _get_baseline_softlabels(self) -> np.ndarray:
-        conn = sqlite3.connect(self._database_path)
-        c = conn.cursor()
-        c.execute(f"SELECT softlabel FROM {self._dim.only_letter}")
-        db_data = c.fetchall()
-        conn.close()
-
-        return np.repeat(np.mean(db_data), len(db_data))
+        return np.repeat(np.mean(self._human_softlabels), len(self._human_softlabels))
 
-    def eval(self, type: LabelType, metrics: List[MetricName]) -> List[float]:
+    def _get_labels(self, type: LabelType) -> Tuple[np.ndarray, np.ndarray]:
         if type == LabelType.SOFT:
-            # y_true, y_pred = np.array(self._get_human_softlables()), np.array(self._get_baseline_softlabels())
-            y_true, y_pred = np.array(self._get_human_softlables()), np.array(self._get_model_softlabels())
+            # return self._get_human_softlables(), self._get_baseline_softlabels()
+            return self._get_human_softlables(), self._get_model_softlabels()
         elif type == LabelType.HARD:
-            y_true, y_pred = np.array(self._get_human_hardlables()), np.array(self._get_model_hardlabels())
+            return self._get_human_hardlables(), self._get_model_hardlabels()
         else:
             assert_never()
+
+    def eval(self, type: LabelType, metrics: List[MetricName]) -> List[float]:
+        y_true, y_pred = self._get_labels(type)
         return [Metric.compute(metric, y_true, y_pred) for metric in metrics]
+
+    def eval_bootstrap(
+        self, type: LabelType, metrics: List[MetricName], n_resamples: int = 2000, seed: int = 0
+    ) -> List[np.ndarray]:
+        # Bootstrap distribution of every metric, see Metric.get_bootstrap_indices for pairing
+        y_true, y_pred = self._get_labels(type)
+        indices = Metric.get_bootstrap_indices(len(y_true), n_resamples, seed)
+        return [Metric.compute_resampled(metric, y_true, y_pred, indices) for metric in metrics]
+
+
+def eval_dimensions(
+    evaluators: Dict[MbtiDimension, Evaluator], type: LabelType, metrics: List[MetricName]
+) -> Dict[MbtiDimension, List[float]]:
+    # Every metric of every dimension in one pass over the (dims, samples) label matrices
+    y_true, y_pred = (np.stack(labels) for labels in zip(*(e._get_labels(type) for e in evaluators.values())))
+    scores = Metric.compute_all(metrics, y_true, y_pred)
+    return {dim: scores[:, i].tolist() for i, dim in enumerate(evaluators)}
+
+
+def eval_dimensions_bootstrap(
+    evaluators: Dict[MbtiDimension, Evaluator],
+    type: LabelType,
+    metrics: List[MetricName],
+    n_resamples: int = 2000,
+    seed: int = 0,
+) -> Dict[MbtiDimension, List[np.ndarray]]:
+    # Same resamples as Evaluator.eval_bootstrap of every dimension, computed on (dims, resamples, samples) arrays
+    y_true, y_pred = (np.stack(labels) for labels in zip(*(e._get_labels(type) for e in evaluators.values())))
+    indices = Metric.get_bootstrap_indices(y_true.shape[-1], n_resamples, seed)
+    scores = Metric.compute_all(metrics, y_true[:, indices], y_pred[:, indices])
+    return {dim: list(scores[:, i]) for i, dim in enumerate(evaluators)}
@@ -2,60 +2,103 @@ import asyncio
 import json
 import logging
 import sqlite3
+import time
 from pathlib import Path
-from typing import Any, Coroutine, Dict, Iterable, List, Sequence
+from typing import Any, Dict, List, Optional
 
 from tqdm.auto import tqdm
 
-from .enums import LabelType, MbtiDimension
+from .database import get_database_writer
+from .dataset import get_dataset
+from .enums import LabelType, MbtiDimension, ResultStatus
+from .evaluator import Exacter
 from .llm import LLM
+from .posts import get_prepared_posts
 from .prompt import PromptMethod
+from .utils import gather_or_cancel
 
 logger = logging.getLogger(__name__)
 
 
-def batch(iterable: Iterable, batch_size: int) -> Iterable:
-    for i in range(0, len(iterable), batch_size):
-        yield iterable[i : i + batch_size]
-
-
-def _limit_concurrency(coroutines: Sequence[Coroutine], concurrency: int) -> List[Coroutine]:
-    semaphore = asyncio.Semaphore(concurrency)
-
-    async def with_concurrency_limit(coroutine: Coroutine) -> Coroutine:
-        async with semaphore:
-            return await coroutine
-
-    return [with_concurrency_limit(coroutine) for coroutine in coroutines]
+# Bump together with a new entry in Executer._migrations_sql
+SCHEMA_VERSION = 3
 
 
 class Executer:
-    def __init__(self, dataset_path: Path, database_path: Path, dim: MbtiDimension, type: LabelType):
+    def __init__(
+        self, dataset_path: Path, database_path: Path, dim: MbtiDimension, type: LabelType, round: Optional[int] = None
+    ):
+        self._dataset = get_dataset(dataset_path)
         self._database_path = database_path
         self._dim = dim
         self._type = type
+        self._round = round  # Part of the response cache key, so rounds do not reuse each other's responses
+        self._prepared_posts: Optional[Dict[int, str]] = None
 
         self._init_database()
-        self._load_data_to_resume(dataset_path)
+        self._load_data_to_resume()
+
+    @property
+    def _max_tokens(self) -> int:
+        return 2048
+
+    @property
+    def _flow(self) -> str:
+        return f"{self._type}--{self._dim.only_letter}"
+
+    @property
+    def _table_name(self) -> str:
+        return self._dim.only_letter
 
     @property
     def _init_database_sql(self) -> str:
         return (
-            f"CREATE TABLE IF NOT EXISTS {self._dim.only_letter} "
-            f"(id INTEGER PRIMARY KEY, messages TEXT, response TEXT, softlabel REAL, hardlabel TEXT, labeltype TEXT)"
+            f"CREATE TABLE IF NOT EXISTS {self._table_name} "
+            f"(id INTEGER PRIMARY KEY, messages TEXT, response TEXT, softlabel REAL, hardlabel TEXT, labeltype TEXT, "
+            f"status TEXT, failures TEXT, softscore REAL, hardchoice TEXT, parsestatus TEXT)"
         )
 
+    @property
+    def _migrations_sql(self) -> List[List[str]]:
+        # _migrations_sql[v] upgrades a table from schema version v to v + 1
+        return [
+            [
+                f"ALTER TABLE {self._table_name} ADD COLUMN status TEXT",
+                f"UPDATE {self._table_name} SET status = CASE WHEN instr(messages, 'OPENAI API ERROR') > 0 "
+                f"THEN '{ResultStatus.ERROR}' ELSE '{ResultStatus.OK}' END",
+            ],
+            [
+                f"ALTER TABLE {self._table_name} ADD COLUMN failures TEXT",
+            ],
+            [
+                # Filled by backfill_parsed_responses
+                f"ALTER TABLE {self._table_name} ADD COLUMN softscore REAL",
+                f"ALTER TABLE {self._table_name} ADD COLUMN hardchoice TEXT",
+                f"ALTER TABLE {self._table_name} ADD COLUMN parsestatus TEXT",
+            ],
+        ]
+
     @property
     def _load_database_sql(self) -> str:
-        return f"SELECT id, messages FROM {self._dim.only_letter}"
+        return f"SELECT id FROM {self._table_name} WHERE status = '{ResultStatus.OK}'"
 
     @property
     def _update_database_sql(self) -> str:
         return (
-            f"INSERT OR REPLACE INTO {self._dim.only_letter} "
-            f"(id, messages, response, softlabel, hardlabel, labeltype) "
+            f"INSERT OR REPLACE INTO {self._table_name} "
+            f"(id, messages, response, softlabel, hardlabel, labeltype, status, failures, "
+            f"softscore, hardchoice, parsestatus) "
             f"VALUES "
-            f"(:id, :messages, :response, :softlabel, :hardlabel, :labeltype)"
+            f"(:id, :messages, :response, :softlabel, :hardlabel, :labeltype, :status, :failures, "
+            f":softscore, :hardchoice, :parsestatus)"
+        )
+
+    @property
+    def _backfill_database_sql(self) -> str:
+        return (
+            f"UPDATE {self._table_name} "
+            f"SET softscore = :softscore, hardchoice = :hardchoice, parsestatus = :parsestatus "
+            f"WHERE id = :id"
         )
 
     def _init_database(self):
@@ -63,68 +106,156 @@ class Executer:
 
         conn = sqlite3.connect(self._database_path)
         c = conn.cursor()
+        c.execute("CREATE TABLE IF NOT EXISTS schema_version (name TEXT PRIMARY KEY, version INTEGER)")
+        c.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (self._table_name,))
+        table_exists = c.fetchone() is not None
         c.execute(self._init_database_sql)
+
+        if table_exists:
+            c.execute("SELECT version FROM schema_version WHERE name = ?", (self._table_name,))
+            row = c.fetchone()
+            version = row[0] if row is not None else 0
+            for migration_version in range(version, SCHEMA_VERSION):
+                logger.info(f"Migrating table {self._table_name} of {self._database_path} to v{migration_version + 1}")
+                for sql in self._migrations_sql[migration_version]:
+                    c.execute(sql)
+
+        c.execute(f"CREATE INDEX IF NOT EXISTS {self._table_name}_status ON {self._table_name} (status, id)")
+        c.execute(
+            "INSERT OR REPLACE INTO schema_version (name, version) VALUES (?, ?)", (self._table_name, SCHEMA_VERSION)
+        )
         conn.commit()
         conn.close()
 
-    def _load_all_data(self, dataset_path: Path) -> List[Dict]:
-        with open(dataset_path) as f:
-            lines = f.readlines()
-        return [json.loads(line.strip()) for line in lines]
+    def backfill_parsed_responses(self) -> int:
+        # Parse the responses of rows written before predictions were stored at write time
+        conn = sqlite3.connect(self._database_path)
+        c = conn.cursor()
+        c.execute(f"SELECT id, response FROM {self._table_name} WHERE parsestatus IS NULL")
+        rows = [{"id": data_id, **self._parse_response(response)} for data_id, response in c.fetchall()]
+        c.executemany(self._backfill_database_sql, rows)
+        conn.commit()
+        conn.close()
+
+        logger.info(f"Backfilled {len(rows)} parsed responses of table {self._table_name} in {self._database_path}")
+        return len(rows)
 
-    def _load_data_to_resume(self, dataset_path: Path):
+    def _load_data_to_resume(self):
         conn = sqlite3.connect(self._database_path)
         c = conn.cursor()
         c.execute(self._load_database_sql)
-        db_data = c.fetchall()
+        finished_ids = {row[0] for row in c.fetchall()}
         conn.close()
 
-        db_data_dict = {row[0]: row[1] for row in db_data}
-        all_data = self._load_all_data(dataset_path)
+        self.ids_to_resume = [data_id for data_id in self._dataset.ids if data_id not in finished_ids]
 
-        self.data_to_resume = [
-            data
-            for data in all_data
-            if data["id"] not in db_data_dict.keys() or "OPENAI API ERROR" in db_data_dict[data["id"]]
-        ]
-
-        logger.info(f"Left {len(self.data_to_resume)} data to resume (Total {len(all_data)})")
+        logger.info(f"Left {len(self.ids_to_resume)} data to resume (Total {len(self._dataset)})")
 
-    async def _single_run(self, llm: LLM, data: Dict, method_cls: Any) -> Dict:
-        user_posts, user_posts_str, user_posts_count = data["posts"], "", 1
-        for i in range(len(user_posts)):
-            if len(user_posts[i]) > 10:
-                post = llm.tokenizer.decode(llm.tokenizer.encode(user_posts[i].replace("{", "").replace("}", ""))[:80])
-                user_posts_str += f"Post {user_posts_count}: {post}; "
-                user_posts_count += 1
+    def _build_prompts(self, llm: LLM, data: Dict, method_cls: Any) -> List[Dict[str, str]]:
+        # Posts are truncated once per dataset and tokenizer, then shared by every dimension and round
+        if self._prepared_posts is None:
+            self._prepared_posts = get_prepared_posts(self._dataset, llm)
+        user_posts_str = self._prepared_posts[data["id"]]
 
         prompt_method: PromptMethod = method_cls(data["source"], self._dim, user_posts_str)
-        prompts = prompt_method.prompts
-
-        messages = llm.chat(prompts)
+        return prompt_method.prompts
 
+    def _build_result(self, llm: LLM, data: Dict, messages: List[Dict[str, str]]) -> Dict:
         return {
             "id": data["id"],
-            "messages": llm.show_real_prompt(messages),
+            "messages": llm.dump_messages(messages),
             "response": messages[-1]["content"],
             "softlabel": data["softlabels"][self._dim.value],
             "hardlabel": data["hardlabels"][self._dim.value],
             "labeltype": self._type.value,
         }
 
-    async def run(self, llm: LLM, method_cls: Any):
-        conn = sqlite3.connect(self._database_path)
-        c = conn.cursor()
+    def _parse_response(self, response: str) -> Dict:
+        return Exacter.parse(self._dim, self._type, response)
 
-        # batch_size is for database write-back
-        # concurrency is for async calls to OpenAI API
-        for batched_data in tqdm(batch(self.data_to_resume, batch_size=20), desc=f"{self._dim}"):
-            tasks = [self._single_run(llm, data, method_cls) for data in batched_data]
-            logger.info(f"Running batched {len(tasks)} tasks")
-            results = await asyncio.gather(*_limit_concurrency(tasks, concurrency=10))
+    def _get_status(self, messages: List[Dict[str, str]]) -> str:
+        # A failure in any turn taints the whole conversation
+        for message in messages:
+            if message["role"] == "assistant" and "OPENAI API ERROR" in message["content"]:
+                return ResultStatus.ERROR.value
+        return ResultStatus.OK.value
 
-            for result in results:
-                c.execute(self._update_database_sql, result)
-            conn.commit()
+    async def _run_conversation(self, llm: LLM, data_id: int, method_cls: Any) -> Dict:
+        data = self._dataset[data_id]
+        prompts = self._build_prompts(llm, data, method_cls)
+        failures = []
+        messages = await llm.chat(
+            prompts, max_tokens=self._max_tokens, flow=self._flow, failures=failures, round=self._round
+        )
+        result = self._build_result(llm, data, messages)
+        return {
+            **result,
+            **self._parse_response(result["response"]),
+            "status": self._get_status(messages),
+            # Failed attempts of every turn, also of turns that succeeded on retry
+            "failures": json.dumps(failures, ensure_ascii=False) if failures else None,
+        }
 
-        conn.close()
+    async def run(
+        self,
+        llm: LLM,
+        method_cls: Any,
+        max_conversations: int = 64,
+        commit_every: int = 20,
+        commit_interval: float = 5.0,
+    ):
+        # Up to max_conversations conversations are kept active, each one starting as soon as another finishes.
+        # Finished results stream to the writer, which commits every commit_every rows or commit_interval seconds.
+        # Concurrency of calls to OpenAI API is governed by the scheduler shared through llm.
+        ids_queue: asyncio.Queue = asyncio.Queue()
+        for data_id in self.ids_to_resume:
+            ids_queue.put_nowait(data_id)
+        results_queue: asyncio.Queue = asyncio.Queue()
+
+        async def worker():
+            while not ids_queue.empty():
+                data_id = ids_queue.get_nowait()
+                await results_queue.put(await self._run_conversation(llm, data_id, method_cls))
+
+        async def produce():
+            try:
+                # A failing worker cancels the others, so they stop sending requests whose results nobody collects
+                await gather_or_cancel(*[worker() for _ in range(min(max_conversations, len(self.ids_to_resume)))])
+            finally:
+                await results_queue.put(None)  # Sentinel, also sent on failure so the writer never waits forever
+
+        producer = asyncio.create_task(produce())
+
+        writer = get_database_writer(self._database_path)
+        progress = tqdm(total=len(self.ids_to_resume), desc=f"{self._dim}")
+        pending_results, last_commit_time, finished = [], time.monotonic(), False
+        try:
+            while not finished:
+                timeout = max(commit_interval - (time.monotonic() - last_commit_time), 0)
+                try:
+                    result = await asyncio.wait_for(results_queue.get(), timeout=timeout)
+                except asyncio.TimeoutError:
+                    result = None
+                else:
+                    if result is None:
+                        finished = True
+                    else:
+                        pending_results.append(result)
+                        progress.update(1)
+
+                if pending_results and (
+                    finished
+                    or len(pending_results) >= commit_every
+                    or time.monotonic() - last_commit_time >= commit_interval
+                ):
+                    logger.info(f"Committing {len(pending_results)} results")
+                    await writer.write(self._update_database_sql, pending_results)
+                    pending_results = []
+                if finished or not pending_results:
+                    last_commit_time = time.monotonic()
+        finally:
+            progress.close()
+            if not producer.done():
+                producer.cancel()
+
+        await producer
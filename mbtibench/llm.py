@@ -1,43 +1,194 @@
+import asyncio
+import hashlib
+import json
 import logging
-from typing import Dict, List, Optional, Tuple
+import sqlite3
+import time
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Callable, Dict, List, Mapping, Optional, Tuple
 
 import tiktoken
-from openai import OpenAI
-from transformers import AutoTokenizer, PreTrainedTokenizer
+from openai import AsyncOpenAI
 
-from .enums import ModelName
+from .enums import CacheMode, ModelName
+from .retry import ChatError, RetryPolicy, classify_error, get_retry_after
+from .scheduler import Scheduler
+
+if TYPE_CHECKING:
+    from transformers import PreTrainedTokenizer
 
 logger = logging.getLogger(__name__)
 
+# Process-wide tokenizer registry, model sizes of the same family share one entry
+_tokenizers: Dict[str, Any] = {}
+
+
+def _load_tokenizer(source: str) -> Any:
+    if source not in _tokenizers:
+        if source.startswith("tiktoken:"):
+            _tokenizers[source] = tiktoken.get_encoding(source[len("tiktoken:") :])
+        else:
+            # transformers is slow to import, only pay for it once a HuggingFace tokenizer is needed
+            from transformers import AutoTokenizer
+
+            tokenizer = AutoTokenizer.from_pretrained(source)
+            tokenizer.add_bos_token = False
+            _tokenizers[source] = tokenizer
+        logger.info(f"Loaded tokenizer {source}")
+    return _tokenizers[source]
+
+
+class ResponseCache:
+    # On-disk, content-addressed cache of single-turn completions with LRU eviction by total response size
+    def __init__(self, path: Path, max_size: int = 1 << 30, mode: CacheMode = CacheMode.READ_WRITE):
+        self._path = path
+        self._max_size = max_size
+        self._mode = mode
+
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(path)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, response TEXT, size INTEGER, accessed REAL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed)")
+        self._conn.commit()
+        self._size = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM cache").fetchone()[0]
+        self._accessed: Dict[str, float] = {}  # Access times of hits not written yet
+
+    @property
+    def mode(self) -> CacheMode:
+        return self._mode
+
+    @staticmethod
+    def make_key(
+        model: str, messages: List[Dict[str, str]], temperature: float, max_tokens: int, round: Optional[int] = None
+    ) -> str:
+        # Every round of an experiment has its own entries, so repeated rounds sample the model again
+        key = [model, messages, temperature, max_tokens] + ([round] if round is not None else [])
+        payload = json.dumps(key, ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        # A cache that cannot be read, e.g. locked by another job for too long, is a miss
+        if self._mode == CacheMode.BYPASS:
+            return None
+
+        try:
+            row = self._conn.execute("SELECT response FROM cache WHERE key = ?", (key,)).fetchone()
+        except sqlite3.Error as e:
+            logger.warning(f"Reading {self._path} failed, querying the endpoint: {e}")
+            return None
+        if row is None:
+            return None
+        if self._mode == CacheMode.READ_WRITE:
+            # Access times are written with the next put, so hits do not commit on their own
+            self._accessed[key] = time.time()
+            if len(self._accessed) >= 1000:
+                self._write(self._flush_accessed)
+        return row[0]
+
+    def put(self, key: str, response: str):
+        if self._mode != CacheMode.READ_WRITE:
+            return
+
+        def insert():
+            self._flush_accessed()
+            size = len(response.encode("utf-8"))
+            old_row = self._conn.execute("SELECT size FROM cache WHERE key = ?", (key,)).fetchone()
+            self._conn.execute(
+                "INSERT OR REPLACE INTO cache (key, response, size, accessed) VALUES (?, ?, ?, ?)",
+                (key, response, size, time.time()),
+            )
+            self._size += size - (old_row[0] if old_row is not None else 0)
+            if self._size > self._max_size:
+                self._evict()
+
+        self._write(insert)
+
+    def _write(self, write: Callable[[], None]):
+        # One transaction, rolled back on failure: the response is still returned, it is only not cached
+        size = self._size
+        try:
+            write()
+            self._conn.commit()
+        except sqlite3.Error as e:
+            logger.warning(f"Writing {self._path} failed, continuing without caching: {e}")
+            self._size = size
+            self._accessed.clear()
+            try:
+                self._conn.rollback()
+            except sqlite3.Error:
+                pass
+
+    def _flush_accessed(self):
+        self._conn.executemany(
+            "UPDATE cache SET accessed = ? WHERE key = ?", [(accessed, key) for key, accessed in self._accessed.items()]
+        )
+        self._accessed.clear()
+
+    def _evict(self):
+        # Evict least recently used entries until the cache is back to 90% of its bound
+        target, evicted = int(self._max_size * 0.9), []
+        for key, size in self._conn.execute("SELECT key, size FROM cache ORDER BY accessed"):
+            if self._size <= target:
+                break
+            evicted.append((key,))
+            self._size -= size
+        self._conn.executemany("DELETE FROM cache WHERE key = ?", evicted)
+        logger.info(f"Evicted {len(evicted)} cached responses from {self._path}")
+
+    def close(self):
+        if self._accessed:
+            self._write(self._flush_accessed)
+        self._conn.close()
+
 
 class LLM:
-    def __init__(self, name: ModelName, base_url: str, api_key: str):
+    def __init__(
+        self,
+        name: ModelName,
+        base_url: str,
+        api_key: str,
+        scheduler: Optional[Scheduler] = None,
+        cache: Optional[ResponseCache] = None,
+        defer_prompt_rendering: bool = False,
+        retry_policy: Optional[RetryPolicy] = None,
+    ):
         self._model_name = name
-        self._model = OpenAI(base_url=base_url, api_key=api_key)
-        self._tokenizer, self._tokenizer_for_demonstration = self._get_tokenizer(name)
+        self._base_url = base_url
+        # Retries are driven by retry_policy, the client must not retry on its own
+        self._model = AsyncOpenAI(base_url=base_url, api_key=api_key, max_retries=0)
+        self._scheduler = scheduler if scheduler is not None else Scheduler()
+        self._retry_policy = retry_policy if retry_policy is not None else RetryPolicy()
+        self._cache = cache
+        self._defer_prompt_rendering = defer_prompt_rendering
+        self._tokenizer_source, self._tokenizer_for_demonstration_source = self._get_tokenizer_sources(name)
+
+    @property
+    def scheduler(self) -> Scheduler:
+        return self._scheduler
 
     @property
-    def tokenizer(self) -> PreTrainedTokenizer:
-        return self._tokenizer
+    def tokenizer(self) -> "PreTrainedTokenizer":
+        return _load_tokenizer(self._tokenizer_source)
 
-    def _get_tokenizer(self, name: ModelName) -> Tuple[PreTrainedTokenizer, PreTrainedTokenizer]:
+    @property
+    def tokenizer_name(self) -> str:
+        # Known without loading the tokenizer, so cached work keyed by it stays lazy
+        return self._tokenizer_source
+
+    def _get_tokenizer_sources(self, name: ModelName) -> Tuple[str, str]:
         if name.is_gpt4:
-            tokenizer = tiktoken.encoding_for_model(name.value)
-            tokenizer_for_demo = AutoTokenizer.from_pretrained("/home/share/models/gpt-4")
-            tokenizer_for_demo.add_bos_token = False
+            return f"tiktoken:{tiktoken.encoding_name_for_model(name.value)}", "/home/share/models/gpt-4"
         elif name.is_llama3_1:
-            tokenizer = AutoTokenizer.from_pretrained("/home/share/models/Meta-Llama-3.1-70B-Instruct")
-            tokenizer.add_bos_token = False
-            tokenizer_for_demo = tokenizer
+            return "/home/share/models/Meta-Llama-3.1-70B-Instruct", "/home/share/models/Meta-Llama-3.1-70B-Instruct"
         elif name.is_qwen2:
-            tokenizer = AutoTokenizer.from_pretrained("/home/share/models/Qwen2-72B-Instruct")
-            tokenizer.add_bos_token = False
-            tokenizer_for_demo = tokenizer
+            return "/home/share/models/Qwen2-72B-Instruct", "/home/share/models/Qwen2-72B-Instruct"
         else:
             raise ValueError(f"Tokenizer not found for model {name}")
 
-        return tokenizer, tokenizer_for_demo
-
     def extract_prompt(self, messages: List[Dict[str, str]]) -> Tuple[Optional[List[Dict[str, str]]], Optional[int]]:
         assert messages[0]["role"] == "system"
         assert len(messages[1:]) % 2 == 0
@@ -52,45 +203,144 @@ class LLM:
 
         return None, None
 
-    def _chat_one_turn(
+    def _report_rate_limit_headers(self, headers: Mapping[str, str], latency: float):
+        remaining_requests = headers.get("x-ratelimit-remaining-requests")
+        if remaining_requests is not None and remaining_requests.isdigit():
+            if int(remaining_requests) < self._scheduler.max_concurrency:
+                self._scheduler.record_congestion(f"x-ratelimit-remaining-requests={remaining_requests}")
+                return
+        self._scheduler.record_success(latency)
+
+    async def _request_one_turn(
+        self,
+        messages: List[Dict[str, str]],
+        temperature: float,
+        max_tokens: int,
+        flow: str,
+    ) -> str:
+        async with self._scheduler.slot(self._base_url, flow):
+            logger.info(f"Chatting with {len(messages[1:])} turns")
+            start_time = time.monotonic()
+            try:
+                raw_response = await self._model.chat.completions.with_raw_response.create(
+                    model=str(self._model_name),
+                    messages=messages,
+                    temperature=temperature,
+                    max_tokens=max_tokens,
+                )
+            except Exception as e:
+                # Any answer from the endpoint, even an error status, shows that it is up
+                if classify_error(e).is_endpoint_down:
+                    self._scheduler.record_endpoint_failure(self._base_url, f"{type(e).__name__}: {e}")
+                else:
+                    self._scheduler.record_endpoint_success(self._base_url)
+                raise
+            latency = time.monotonic() - start_time
+            self._scheduler.record_endpoint_success(self._base_url)
+        self._report_rate_limit_headers(raw_response.headers, latency)
+        return raw_response.parse().choices[0].message.content
+
+    async def _chat_one_turn(
         self,
         messages: List[Dict[str, str]],
         temperature: float = 0,
         max_tokens=2048,
-    ) -> List[Dict[str, str]]:
-        try:
-            logger.info(f"Chatting with {len(messages[1:])} turns")
-            response = self._model.chat.completions.create(
-                model=str(self._model_name),
-                messages=messages,
-                temperature=temperature,
-                max_tokens=max_tokens,
-            )
-            response_content = response.choices[0].message.content
-        except Exception as e:
-            response_content = f"OPENAI API ERROR: {e}"
+        flow: str = "default",
+        failures: Optional[List[Dict[str, Any]]] = None,
+        round: Optional[int] = None,
+    ) -> str:
+        # messages end right before the placeholder, so multi-turn methods hit the cache turn by turn.
+        # Every failed attempt is appended to failures, ChatError is raised once the turn is given up.
+        cache_key = None
+        if self._cache is not None:
+            cache_key = ResponseCache.make_key(str(self._model_name), messages, temperature, max_tokens, round)
+            response_content = self._cache.get(cache_key)
+            if response_content is not None:
+                logger.info(f"Cache hit for {len(messages[1:])} turns")
+                return response_content
 
-        return response_content
+        attempt = 1
+        while True:
+            try:
+                response_content = await self._request_one_turn(messages, temperature, max_tokens, flow)
+            except ChatError as e:
+                # The scheduler gave up the endpoint, every further attempt would fail the same way
+                if failures is not None:
+                    failures.append(
+                        {"turn": len(messages) // 2, "attempt": attempt, "kind": e.kind.value, "error": str(e)}
+                    )
+                raise
+            except Exception as e:
+                kind = classify_error(e)
+                if kind.is_congestion:
+                    self._scheduler.record_congestion(type(e).__name__)
+                if failures is not None:
+                    failures.append(
+                        {"turn": len(messages) // 2, "attempt": attempt, "kind": kind.value, "error": str(e)}
+                    )
+                if not self._retry_policy.should_retry(kind, attempt):
+                    logger.warning(f"Giving up {kind} error after {attempt} attempts: {e}")
+                    raise ChatError(kind, str(e)) from e
+
+                delay = self._retry_policy.get_delay(attempt, get_retry_after(e))
+                logger.info(f"Retrying {kind} error in {delay:.1f}s (attempt {attempt}): {e}")
+                await asyncio.sleep(delay)
+                attempt += 1
+            else:
+                if cache_key is not None and response_content is not None:
+                    self._cache.put(cache_key, response_content)
+                return response_content
 
-    def chat(
+    def _fail_conversation(self, messages: List[Dict[str, str]], error: ChatError):
+        # Later turns build on the failed one, so they are not sent and carry the error as well
+        while True:
+            _, placeholder_index = self.extract_prompt(messages)
+            if placeholder_index is None:
+                break
+            messages[placeholder_index]["content"] = f"OPENAI API ERROR: {error}"
+
+    async def chat(
         self,
         messages: List[Dict[str, str]],
         temperature: float = 0,
         max_tokens=2048,
+        flow: str = "default",
+        failures: Optional[List[Dict[str, Any]]] = None,
+        round: Optional[int] = None,
     ) -> List[Dict[str, str]]:
         while True:
             extracted_messages, placeholder_index = self.extract_prompt(messages)
             if extracted_messages is None and placeholder_index is None:
                 break
             logger.info(f"Found [[PLACEHOLDER]] in message[{placeholder_index}], chat in new turn")
-            response_content = self._chat_one_turn(extracted_messages, temperature, max_tokens)
-            messages[placeholder_index]["content"] = response_content
+            try:
+                response_content = await self._chat_one_turn(
+                    extracted_messages, temperature, max_tokens, flow, failures, round
+                )
+            except ChatError as e:
+                self._fail_conversation(messages, e)
+                break
+            # Refusals come back with content None, they are kept as an empty response that fails to parse
+            messages[placeholder_index]["content"] = response_content if response_content is not None else ""
 
         assert messages[-1]["role"] == "assistant"
 
         return messages
 
     def show_real_prompt(self, messages: List[Dict[str, str]]) -> str:
-        return self._tokenizer_for_demonstration.apply_chat_template(
+        return _load_tokenizer(self._tokenizer_for_demonstration_source).apply_chat_template(
             messages, tokenize=False, add_generation_prompt=False
         )
+
+    def dump_messages(self, messages: List[Dict[str, str]]) -> str:
+        # With deferred rendering the structured messages are stored, see render_messages
+        if self._defer_prompt_rendering:
+            return json.dumps(messages, ensure_ascii=False)
+        return self.show_real_prompt(messages)
+
+    def render_messages(self, stored: str) -> str:
+        try:
+            messages = json.loads(stored)
+        except json.JSONDecodeError:
+            return stored  # Already rendered
+        return self.show_real_prompt(messages) if isinstance(messages, list) else stored
@@ -0,0 +1,75 @@
+import json
+import logging
+import os
+import re
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+from .dataset import JsonlDataset
+from .llm import LLM
+
+logger = logging.getLogger(__name__)
+
+_prepared_posts: Dict[Tuple[str, str, int], Dict[int, str]] = {}
+
+
+def _truncate_posts(llm: LLM, posts: List[str], max_tokens: int, batch_size: int = 1024) -> List[str]:
+    tokenizer, truncated = llm.tokenizer, []
+    for i in range(0, len(posts), batch_size):
+        texts = posts[i : i + batch_size]
+        if hasattr(tokenizer, "encode_batch"):  # tiktoken
+            token_ids = tokenizer.encode_batch(texts)
+            truncated.extend(tokenizer.decode_batch([ids[:max_tokens] for ids in token_ids]))
+        else:  # HuggingFace fast tokenizer
+            token_ids = tokenizer(texts)["input_ids"]
+            truncated.extend(tokenizer.batch_decode([ids[:max_tokens] for ids in token_ids]))
+    return truncated
+
+
+def _prepare_posts(dataset: JsonlDataset, llm: LLM, max_tokens: int) -> Dict[int, str]:
+    # Posts of 10 characters or fewer are skipped, as in the original per-post loop
+    owners, posts = [], []
+    for data in dataset:
+        for post in data["posts"]:
+            if len(post) > 10:
+                owners.append(data["id"])
+                posts.append(post.replace("{", "").replace("}", ""))
+
+    prepared_posts, post_counts = {data_id: "" for data_id in dataset.ids}, {}
+    for owner, post in zip(owners, _truncate_posts(llm, posts, max_tokens)):
+        post_counts[owner] = post_counts.get(owner, 0) + 1
+        prepared_posts[owner] += f"Post {post_counts[owner]}: {post}; "
+    return prepared_posts
+
+
+def get_prepared_posts(
+    dataset: JsonlDataset,
+    llm: LLM,
+    max_tokens: int = 80,
+    cache_dir: Path = Path("results") / "prepared-posts",
+) -> Dict[int, str]:
+    # User posts joined into one prompt string, each post truncated to max_tokens tokens.
+    # Memoized per process and persisted per (dataset content, tokenizer, max_tokens), so the
+    # tokenizer itself is only loaded when the posts are not on disk yet.
+    dataset_digest = dataset.digest
+    key = (dataset_digest, llm.tokenizer_name, max_tokens)
+    if key in _prepared_posts:
+        return _prepared_posts[key]
+
+    tokenizer_slug = re.sub(r"[^0-9A-Za-z.-]+", "_", llm.tokenizer_name).strip("_")
+    cache_path = cache_dir / f"{tokenizer_slug}--{dataset_digest[:16]}--{max_tokens}.json"
+    if cache_path.exists():
+        with open(cache_path) as f:
+            prepared_posts = {int(data_id): posts for data_id, posts in json.load(f).items()}
+        logger.info(f"Loaded prepared posts from {cache_path}")
+    else:
+        prepared_posts = _prepare_posts(dataset, llm, max_tokens)
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        tmp_path = cache_path.with_name(f"{cache_path.name}.{os.getpid()}.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(prepared_posts, f, ensure_ascii=False)
+        os.replace(tmp_path, cache_path)
+        logger.info(f"Saved prepared posts to {cache_path}")
+
+    _prepared_posts[key] = prepared_posts
+    return prepared_posts
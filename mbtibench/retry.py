@@ -0,0 +1,71 @@
+import random
+from typing import Optional
+
+from openai import (
+    APIConnectionError,
+    APIStatusError,
+    APITimeoutError,
+    BadRequestError,
+    InternalServerError,
+    RateLimitError,
+)
+
+from .enums import ErrorKind
+
+
+class ChatError(Exception):
+    # Raised once a turn has failed for good, either on a non-retryable error or after the last attempt
+    def __init__(self, kind: ErrorKind, message: str):
+        super().__init__(message)
+        self.kind = kind
+
+
+class RetryPolicy:
+    # Exponential backoff with full jitter, so that requests failing together do not retry together
+    def __init__(self, max_attempts: int = 6, base_delay: float = 1.0, max_delay: float = 60.0):
+        assert max_attempts > 0
+        assert 0 < base_delay <= max_delay
+        self._max_attempts = max_attempts
+        self._base_delay = base_delay
+        self._max_delay = max_delay
+
+    @property
+    def max_attempts(self) -> int:
+        return self._max_attempts
+
+    def should_retry(self, kind: ErrorKind, attempt: int) -> bool:
+        # attempt counts from 1
+        return kind.retryable and attempt < self._max_attempts
+
+    def get_delay(self, attempt: int, retry_after: Optional[float] = None) -> float:
+        delay = random.uniform(0, min(self._max_delay, self._base_delay * 2 ** (attempt - 1)))
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, self._max_delay))
+        return delay
+
+
+def classify_error(e: Exception) -> ErrorKind:
+    # APITimeoutError is a subclass of APIConnectionError, so it has to be checked first
+    if isinstance(e, RateLimitError):
+        return ErrorKind.RATE_LIMIT
+    elif isinstance(e, APITimeoutError):
+        return ErrorKind.TIMEOUT
+    elif isinstance(e, APIConnectionError):
+        return ErrorKind.CONNECTION
+    elif isinstance(e, InternalServerError):
+        return ErrorKind.SERVER
+    elif isinstance(e, BadRequestError) and (e.code == "context_length_exceeded" or "context length" in str(e).lower()):
+        # OpenAI sets the error code, vLLM only says "This model's maximum context length is ..."
+        return ErrorKind.CONTEXT_LENGTH
+    else:
+        return ErrorKind.OTHER
+
+
+def get_retry_after(e: Exception) -> Optional[float]:
+    if not isinstance(e, APIStatusError):
+        return None
+    retry_after = e.response.headers.get("retry-after")
+    try:
+        return float(retry_after) if retry_after is not None else None
+    except ValueError:
+        return None  # HTTP-date form, fall back to the backoff delay
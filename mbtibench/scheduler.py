@@ -0,0 +1,330 @@
+import asyncio
+import logging
+import math
+import time
+from collections import OrderedDict, defaultdict, deque
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Deque, Dict, List, Optional, Tuple
+
+from .enums import ErrorKind
+from .retry import ChatError
+
+logger = logging.getLogger(__name__)
+
+
+class AimdController:
+    # Additive increase while p95 latency stays flat, multiplicative decrease on congestion
+    def __init__(
+        self,
+        initial_concurrency: int = 10,
+        min_concurrency: int = 1,
+        max_concurrency: int = 256,
+        window: int = 20,
+        latency_tolerance: float = 1.25,
+        increase: int = 1,
+        latency_decrease: float = 0.9,
+        congestion_decrease: float = 0.5,
+        cooldown: float = 5.0,
+    ):
+        assert 0 < min_concurrency <= initial_concurrency <= max_concurrency
+        self._min_concurrency = min_concurrency
+        self._max_concurrency = max_concurrency
+        self._window = window
+        self._latency_tolerance = latency_tolerance
+        self._increase = increase
+        self._latency_decrease = latency_decrease
+        self._congestion_decrease = congestion_decrease
+        self._cooldown = cooldown
+
+        self._limit = initial_concurrency
+        self._latencies: List[float] = []
+        self._baseline_p95: Optional[float] = None
+        self._last_decrease = -math.inf
+
+    @property
+    def limit(self) -> int:
+        return self._limit
+
+    @property
+    def baseline_p95(self) -> Optional[float]:
+        return self._baseline_p95
+
+    def on_success(self, latency: float):
+        self._latencies.append(latency)
+        if len(self._latencies) < self._window:
+            return
+
+        latencies, self._latencies = sorted(self._latencies), []
+        p95 = latencies[math.ceil(0.95 * len(latencies)) - 1]
+        if self._baseline_p95 is None:
+            self._baseline_p95 = p95
+
+        if p95 <= self._baseline_p95 * self._latency_tolerance:
+            self._limit = min(self._limit + self._increase, self._max_concurrency)
+        else:
+            logger.info(f"p95 latency {p95:.2f}s exceeds baseline {self._baseline_p95:.2f}s")
+            self._decrease(self._latency_decrease)
+
+        # The baseline is the fastest window seen. Following accepted windows upwards would let latency creep up
+        # window after window without ever backing off.
+        self._baseline_p95 = min(p95, self._baseline_p95)
+
+    def on_congestion(self, reason: str):
+        logger.warning(f"Congestion signal from endpoint: {reason}")
+        self._latencies = []
+        self._decrease(self._congestion_decrease)
+
+    def _decrease(self, factor: float):
+        # A burst of signals usually stems from one congestion event, so back off at most once per cooldown
+        now = time.monotonic()
+        if now - self._last_decrease < self._cooldown:
+            return
+        self._last_decrease = now
+        self._limit = max(int(self._limit * factor), self._min_concurrency)
+
+
+class CircuitBreaker:
+    # Opens after failure_threshold consecutive failures of an endpoint. Once reset_timeout has passed, a single probe
+    # request is let through: success closes the circuit, failure opens it again for twice as long. After
+    # max_probe_failures failed probes in a row the endpoint is given up for good.
+    def __init__(
+        self,
+        endpoint: str,
+        failure_threshold: int = 5,
+        reset_timeout: float = 30.0,
+        max_reset_timeout: float = 300.0,
+        max_probe_failures: int = 5,
+    ):
+        assert failure_threshold > 0
+        assert 0 < reset_timeout <= max_reset_timeout
+        assert max_probe_failures > 0
+        self._endpoint = endpoint
+        self._failure_threshold = failure_threshold
+        self._reset_timeout = reset_timeout
+        self._max_reset_timeout = max_reset_timeout
+        self._max_probe_failures = max_probe_failures
+
+        self._failures = 0
+        self._probe_failures = 0
+        self._timeout = reset_timeout
+        self._open_until: Optional[float] = None  # None while the circuit is closed
+
+    @property
+    def is_open(self) -> bool:
+        return self._open_until is not None
+
+    @property
+    def is_given_up(self) -> bool:
+        return self._probe_failures >= self._max_probe_failures
+
+    @property
+    def retry_in(self) -> float:
+        return max(self._open_until - time.monotonic(), 0) if self._open_until is not None else 0
+
+    def allows(self, endpoint_in_flight: int) -> bool:
+        if self._open_until is None:
+            return True
+        if self.is_given_up:
+            return False
+        return time.monotonic() >= self._open_until and endpoint_in_flight == 0
+
+    def on_success(self):
+        if self._open_until is not None:
+            if time.monotonic() < self._open_until:
+                return  # Request sent before the circuit opened
+            logger.info(f"Circuit of {self._endpoint} closed")
+        self._failures = 0
+        self._probe_failures = 0
+        self._timeout = self._reset_timeout
+        self._open_until = None
+
+    def on_failure(self, reason: str):
+        self._failures += 1
+        now = time.monotonic()
+        if self._open_until is not None:
+            if now < self._open_until or self.is_given_up:
+                return  # Request sent before the circuit opened, or the endpoint is given up already
+            self._probe_failures += 1
+            if self.is_given_up:
+                logger.error(f"Giving up {self._endpoint} after {self._probe_failures} failed probes: {reason}")
+                return
+            self._timeout = min(self._timeout * 2, self._max_reset_timeout)
+        elif self._failures < self._failure_threshold:
+            return
+        self._open_until = now + self._timeout
+        logger.warning(
+            f"Circuit of {self._endpoint} opened for {self._timeout:.0f}s after {self._failures} failures: {reason}"
+        )
+
+
+class Scheduler:
+    # Global and per-endpoint in-flight limits, with waiting requests served round-robin across flows.
+    # Endpoints that keep failing are paused by a circuit breaker.
+    def __init__(
+        self,
+        max_concurrency: int = 40,
+        endpoint_concurrency: Optional[Dict[str, int]] = None,
+        controller: Optional[AimdController] = None,
+        failure_threshold: int = 5,
+        reset_timeout: float = 30.0,
+        max_probe_failures: int = 5,
+    ):
+        assert max_concurrency > 0
+        self._controller = controller
+        self._failure_threshold = failure_threshold
+        self._reset_timeout = reset_timeout
+        self._max_probe_failures = max_probe_failures
+        self._max_concurrency = controller.limit if controller is not None else max_concurrency
+        self._endpoint_concurrency = dict(endpoint_concurrency or {})
+        self._in_flight = 0
+        self._endpoint_in_flight: Dict[str, int] = defaultdict(int)
+        self._queues: "OrderedDict[str, Deque[Tuple[str, asyncio.Future]]]" = OrderedDict()
+        self._breakers: Dict[str, CircuitBreaker] = {}
+        self._wakeups: Dict[str, asyncio.TimerHandle] = {}
+
+    @property
+    def max_concurrency(self) -> int:
+        return self._max_concurrency
+
+    @property
+    def in_flight(self) -> int:
+        return self._in_flight
+
+    @property
+    def waiting(self) -> int:
+        return sum(len(queue) for queue in self._queues.values())
+
+    def set_endpoint_concurrency(self, endpoint: str, concurrency: int):
+        assert concurrency > 0
+        self._endpoint_concurrency[endpoint] = concurrency
+        self._dispatch()
+
+    def record_success(self, latency: float):
+        if self._controller is not None:
+            self._controller.on_success(latency)
+            self._apply_controller_limit()
+
+    def record_congestion(self, reason: str):
+        if self._controller is not None:
+            self._controller.on_congestion(reason)
+            self._apply_controller_limit()
+
+    def record_endpoint_success(self, endpoint: str):
+        self._get_breaker(endpoint).on_success()
+        self._dispatch()
+
+    def record_endpoint_failure(self, endpoint: str, reason: str):
+        # While the circuit of an endpoint is open its waiting requests stay queued, so they use up no retries.
+        # Once the endpoint is given up they fail instead, so the run ends and a resume picks the rows up later.
+        breaker = self._get_breaker(endpoint)
+        breaker.on_failure(reason)
+        if breaker.is_given_up:
+            if endpoint in self._wakeups:
+                self._wakeups.pop(endpoint).cancel()
+            self._fail_waiting(endpoint)
+        elif breaker.is_open:
+            if endpoint in self._wakeups:
+                self._wakeups[endpoint].cancel()
+            self._wakeups[endpoint] = asyncio.get_running_loop().call_later(breaker.retry_in, self._dispatch)
+
+    def _get_breaker(self, endpoint: str) -> CircuitBreaker:
+        if endpoint not in self._breakers:
+            self._breakers[endpoint] = CircuitBreaker(
+                endpoint, self._failure_threshold, self._reset_timeout, max_probe_failures=self._max_probe_failures
+            )
+        return self._breakers[endpoint]
+
+    def _apply_controller_limit(self):
+        limit = self._controller.limit
+        if limit == self._max_concurrency:
+            return
+        logger.info(
+            f"Concurrency limit {self._max_concurrency} -> {limit} "
+            f"(in flight {self._in_flight}, waiting {self.waiting}, baseline p95 {self._controller.baseline_p95})"
+        )
+        self._max_concurrency = limit
+        self._dispatch()
+
+    @asynccontextmanager
+    async def slot(self, endpoint: str, flow: str = "default") -> AsyncIterator[None]:
+        await self._acquire(endpoint, flow)
+        try:
+            yield
+        finally:
+            self._release(endpoint)
+
+    def _has_capacity(self, endpoint: str) -> bool:
+        if self._in_flight >= self._max_concurrency:
+            return False
+        endpoint_limit = self._endpoint_concurrency.get(endpoint)
+        if endpoint_limit is not None and self._endpoint_in_flight[endpoint] >= endpoint_limit:
+            return False
+        return endpoint not in self._breakers or self._breakers[endpoint].allows(self._endpoint_in_flight[endpoint])
+
+    def _get_given_up_error(self, endpoint: str) -> ChatError:
+        return ChatError(ErrorKind.CONNECTION, f"{endpoint} given up after {self._max_probe_failures} failed probes")
+
+    def _fail_waiting(self, endpoint: str):
+        for flow, queue in list(self._queues.items()):
+            for item in [item for item in queue if item[0] == endpoint]:
+                queue.remove(item)
+                if not item[1].done():
+                    item[1].set_exception(self._get_given_up_error(endpoint))
+            if not queue:
+                del self._queues[flow]
+
+    async def _acquire(self, endpoint: str, flow: str):
+        if endpoint in self._breakers and self._breakers[endpoint].is_given_up:
+            raise self._get_given_up_error(endpoint)
+        future = asyncio.get_running_loop().create_future()
+        self._queues.setdefault(flow, deque()).append((endpoint, future))
+        self._dispatch()
+
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # Failed by _fail_waiting before the task resumed: no slot was granted, the error is dropped
+                if future.exception() is None:
+                    # The slot was granted right before cancellation, hand it back
+                    self._release(endpoint)
+            else:
+                self._discard(flow, future)
+            raise
+
+    def _release(self, endpoint: str):
+        self._in_flight -= 1
+        self._endpoint_in_flight[endpoint] -= 1
+        self._dispatch()
+
+    def _discard(self, flow: str, future: asyncio.Future):
+        queue = self._queues.get(flow)
+        if queue is None:
+            return
+        for item in list(queue):
+            if item[1] is future:
+                queue.remove(item)
+        if not queue:
+            del self._queues[flow]
+
+    def _dispatch(self):
+        # Serve flows round-robin: grant the head of the first flow that can run, then move that flow to the back
+        while self._queues and self._in_flight < self._max_concurrency:
+            for flow, queue in self._queues.items():
+                endpoint, future = queue[0]
+                if future.done():
+                    queue.popleft()
+                    break
+                if self._has_capacity(endpoint):
+                    queue.popleft()
+                    self._in_flight += 1
+                    self._endpoint_in_flight[endpoint] += 1
+                    future.set_result(None)
+                    break
+            else:
+                return  # Every waiting flow is blocked by its endpoint limit or circuit
+
+            if queue:
+                self._queues.move_to_end(flow)
+            else:
+                del self._queues[flow]
@@ -1,7 +1,8 @@
+import asyncio
 import logging
 import os
 from datetime import datetime
-from typing import Optional, Tuple
+from typing import Any, Awaitable, List, Optional, Tuple
 
 import requests
 from dateutil.relativedelta import relativedelta
@@ -24,6 +25,17 @@ def get_base_url_and_api_key(host: Optional[str], port: Optional[int]) -> Tuple[
     return base_url, api_key
 
 
+async def gather_or_cancel(*awaitables: Awaitable) -> List[Any]:
+    # asyncio.gather that cancels the others once one fails, instead of leaving them running (TaskGroup needs 3.11)
+    tasks = [asyncio.ensure_future(awaitable) for awaitable in awaitables]
+    try:
+        return await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
 def get_credit_info():
     base_url, api_key = get_base_url_and_api_key(None, None)
 
@@ -0,0 +1,220 @@
+import json
+import logging
+import os
+import shutil
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+from .database import connect_readonly, get_columns
+from .enums import LabelType, MbtiDimension, ModelName, PromptMethodName
+from .evaluator import Evaluator, Exacter
+
+logger = logging.getLogger(__name__)
+
+# Result rows of all runs, without the messages column which is only needed to inspect single conversations
+SCHEMA = pa.schema(
+    [
+        ("id", pa.int64()),
+        ("response", pa.string()),
+        ("softlabel", pa.float64()),
+        ("hardlabel", pa.string()),
+        ("labeltype", pa.string()),
+        ("status", pa.string()),
+        ("failures", pa.string()),
+        ("softscore", pa.float64()),
+        ("hardchoice", pa.string()),
+        ("parsestatus", pa.string()),
+    ]
+)
+
+PARTITIONING = ds.partitioning(
+    pa.schema(
+        [
+            ("model", pa.string()),
+            ("method", pa.string()),
+            ("type", pa.string()),
+            ("round", pa.int32()),
+            ("dim", pa.string()),
+        ]
+    ),
+    flavor="hive",
+)
+
+
+def parse_database_path(database_path: Path) -> Optional[Tuple[LabelType, ModelName, PromptMethodName, int]]:
+    # results/round-{round}/{type}--{model}--{method}.db, see inference.py
+    try:
+        type, model, method = database_path.stem.split("--")
+        return (
+            LabelType(type),
+            ModelName(model),
+            PromptMethodName(method),
+            int(database_path.parent.name[len("round-") :]),
+        )
+    except ValueError:
+        return None
+
+
+class Warehouse:
+    # Parquet store of all result databases, one file per model/method/type/round/dim partition.
+    # _manifest.json records the size and mtime of every ingested database, so ingest only reads changed ones.
+    def __init__(self, root: Path):
+        self._root = root
+        self._manifest_path = root / "_manifest.json"
+
+    @property
+    def root(self) -> Path:
+        return self._root
+
+    def get_partition_path(
+        self, model: ModelName, method: PromptMethodName, type: LabelType, round: int, dim: MbtiDimension
+    ) -> Path:
+        return (
+            self._root
+            / f"model={model}"
+            / f"method={method}"
+            / f"type={type}"
+            / f"round={round}"
+            / f"dim={dim.only_letter}"
+            / "part-0.parquet"
+        )
+
+    def _load_manifest(self) -> Dict[str, List[int]]:
+        if not self._manifest_path.exists():
+            return {}
+        with open(self._manifest_path) as f:
+            return json.load(f)
+
+    def _save_manifest(self, manifest: Dict[str, List[int]]):
+        tmp_path = self._manifest_path.with_name(f".{self._manifest_path.name}.{os.getpid()}.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, self._manifest_path)
+
+    @staticmethod
+    def _get_signature(database_path: Path) -> List[int]:
+        # Rows committed in WAL mode may still sit in the -wal file. An empty -wal holds no rows, and reading a
+        # database creates or touches one, so it is left out.
+        signature = []
+        for path in [database_path, database_path.with_name(f"{database_path.name}-wal")]:
+            if path.exists():
+                stat = path.stat()
+                if path == database_path or stat.st_size > 0:
+                    signature += [stat.st_size, stat.st_mtime_ns]
+        return signature
+
+    def _read_database(self, database_path: Path, type: LabelType) -> Dict[MbtiDimension, pa.Table]:
+        tables = {}
+        conn = connect_readonly(database_path)
+        for dim in MbtiDimension:
+            columns = get_columns(conn, dim.only_letter)
+            if not columns:
+                continue
+            select = ", ".join(name if name in columns else f"NULL AS {name}" for name in SCHEMA.names)
+            rows = conn.execute(f"SELECT {select} FROM {dim.only_letter} ORDER BY id").fetchall()
+            records = [dict(zip(SCHEMA.names, row)) for row in rows]
+            for record in records:
+                if record["parsestatus"] is None:
+                    record.update(Exacter.parse(dim, type, record["response"]))
+            tables[dim] = pa.Table.from_pylist(records, schema=SCHEMA)
+        conn.close()
+        return tables
+
+    def _remove_partitions(self, type: LabelType, model: ModelName, method: PromptMethodName, round: int):
+        round_path = self.get_partition_path(model, method, type, round, MbtiDimension.EI).parent.parent
+        if round_path.exists():
+            shutil.rmtree(round_path)
+        for path in round_path.parents:
+            if path == self._root or not path.exists() or any(path.iterdir()):
+                break
+            path.rmdir()
+
+    def ingest(self, results_dir: Path) -> int:
+        # Returns the number of (re-)ingested databases, partitions of deleted databases are removed
+        self._root.mkdir(parents=True, exist_ok=True)
+        manifest = self._load_manifest()
+
+        database_paths = {}
+        for database_path in sorted(results_dir.glob("round-*/*.db")):
+            if parse_database_path(database_path) is None:
+                logger.warning(f"Skipping {database_path}, not a result database")
+                continue
+            database_paths[database_path.relative_to(results_dir).as_posix()] = database_path
+
+        for key in [key for key in manifest if key not in database_paths]:
+            logger.info(f"Removing partitions of deleted {key}")
+            self._remove_partitions(*parse_database_path(results_dir / key))
+            del manifest[key]
+            self._save_manifest(manifest)
+
+        ingested = 0
+        for key, database_path in database_paths.items():
+            signature = self._get_signature(database_path)
+            if manifest.get(key) == signature:
+                continue
+
+            type, model, method, round = parse_database_path(database_path)
+            for dim, table in self._read_database(database_path, type).items():
+                partition_path = self.get_partition_path(model, method, type, round, dim)
+                partition_path.parent.mkdir(parents=True, exist_ok=True)
+                tmp_path = partition_path.with_name(f".{partition_path.name}.{os.getpid()}.tmp")
+                pq.write_table(table, tmp_path)
+                os.replace(tmp_path, partition_path)
+
+            # Saved after every database, so an interrupted ingest resumes where it stopped
+            manifest[key] = signature
+            self._save_manifest(manifest)
+            ingested += 1
+            logger.info(f"Ingested {database_path}")
+
+        return ingested
+
+    def read(
+        self,
+        model: Optional[ModelName] = None,
+        method: Optional[PromptMethodName] = None,
+        type: Optional[LabelType] = None,
+        round: Optional[int] = None,
+        dim: Optional[MbtiDimension] = None,
+        columns: Optional[List[str]] = None,
+    ) -> pa.Table:
+        # Rows of all matching partitions, with the partition keys as columns. Use .to_pandas() for analysis.
+        dataset = ds.dataset(self._root, format="parquet", partitioning=PARTITIONING)
+        filters = [
+            ds.field(name) == value
+            for name, value in [
+                ("model", str(model) if model is not None else None),
+                ("method", str(method) if method is not None else None),
+                ("type", str(type) if type is not None else None),
+                ("round", round),
+                ("dim", dim.only_letter if dim is not None else None),
+            ]
+            if value is not None
+        ]
+        expression = None
+        for f in filters:
+            expression = f if expression is None else expression & f
+        return dataset.to_table(columns=columns, filter=expression)
+
+
+class WarehouseEvaluator(Evaluator):
+    # Evaluator over one partition of the warehouse instead of a result database
+    def __init__(
+        self,
+        warehouse: Warehouse,
+        model: ModelName,
+        method: PromptMethodName,
+        type: LabelType,
+        round: int,
+        dim: MbtiDimension,
+    ):
+        super().__init__(warehouse.get_partition_path(model, method, type, round, dim), dim)
+
+    def _fetch_rows(self) -> List[Tuple]:
+        columns = ["id", "response", "softlabel", "hardlabel", "labeltype", "softscore", "hardchoice", "parsestatus"]
+        table = pq.read_table(self._database_path, columns=columns)
+        return list(zip(*[table.column(name).to_pylist() for name in columns]))
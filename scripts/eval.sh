@@ -19,10 +19,5 @@ types=(
 )
     # hard
 
-for t in ${types[@]}; do
-    for b in ${models[@]}; do
-        for m in ${methods[@]}; do
-            python evaluate.py --model $b --method $m --type $t
-        done
-    done
-done
+# All configurations are evaluated in one process pool and summarized in one table
+python evaluate.py --grid --models ${models[@]} --methods ${methods[@]} --types ${types[@]} --output results/leaderboard.csv
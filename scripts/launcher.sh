@@ -19,23 +19,16 @@ types=(
 )
     # hard
 
-rounds=(
-    1
-    2
-    3
-    4
-    5
-)
+# All rounds of a configuration run in one job, see --rounds of inference.py
+rounds=1-5
 
-for r in ${rounds[@]}; do
-    for t in ${types[@]}; do
-        for m in ${methods[@]}; do
-            for b in ${models[@]}; do
-                sbatch -J mbtibench_${b}_${m}_${t} \
-                    -o log/mbtibench_${b}_${m}_${t}_%j.log \
-                    --export=method=$m,model=$b,type=$t,round=$r \
-                    scripts/run.sh
-            done
+for t in ${types[@]}; do
+    for m in ${methods[@]}; do
+        for b in ${models[@]}; do
+            sbatch -J mbtibench_${b}_${m}_${t} \
+                -o log/mbtibench_${b}_${m}_${t}_%j.log \
+                --export=method=$m,model=$b,type=$t,rounds=$rounds \
+                scripts/run.sh
         done
     done
 done